@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CommentsConfig(AppConfig):
     name = 'comments'
+
+    def ready(self):
+        from comments.registry import clear_registries
+
+        # Content types may have been created or recreated
+        post_migrate.connect(clear_registries, dispatch_uid='comments.clear_registries')
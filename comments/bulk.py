@@ -0,0 +1,191 @@
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Case, F, Max, TextField, Value, When
+from rest_framework.fields import DateTimeField
+
+from comments.cache import invalidate_comments
+from comments.events import COMMENT_CREATED, publish_comment
+from comments.models import Comment, CommentCounter
+from comments.tree import lock_tree_ids, path_segment, tree_storage
+
+
+def check_comments(items, registry):
+    """
+    Validate a batch of comments with one query per kind of referenced object,
+    content types are taken from ``registry``.
+
+    ``items`` are dicts with ``user``, ``text``, ``content_type``, ``object_id``
+    and either an existing ``parent`` id or the ``parent_index`` of an earlier
+    item. Returns the parents found, by id, and an error dict per item.
+    """
+    errors = [{} for _ in items]
+    users = set(User.objects.filter(pk__in={item['user'] for item in items}).values_list('pk', flat=True))
+    resolvers = {ct_id: registry.resolver(ct_id) for ct_id in {item['content_type'] for item in items}}
+    allowed_types = {ct_id: resolver for ct_id, resolver in resolvers.items() if resolver is not None}
+    parent_ids = {item['parent'] for item in items if item.get('parent') is not None}
+    parents = {row['pk']: row for row in Comment.objects.filter(pk__in=parent_ids).values(
+        'pk', 'content_type_id', 'object_id', 'tree_id', 'level', 'path')}
+
+    object_ids = defaultdict(set)
+    for item in items:
+        if item['content_type'] in allowed_types:
+            object_ids[item['content_type']].add(item['object_id'])
+    existing = set()
+    for ct_id, ids in object_ids.items():
+        existing.update((ct_id, pk) for pk in allowed_types[ct_id].existing(ids))
+
+    levels = []
+    for index, (item, error) in enumerate(zip(items, errors)):
+        if item['user'] not in users:
+            error['user'] = [f'Invalid pk "{item["user"]}" - object does not exist.']
+        if item['content_type'] not in allowed_types:
+            error['content_type'] = [f'Invalid pk "{item["content_type"]}" - object does not exist.']
+        elif (item['content_type'], item['object_id']) not in existing:
+            error['object_id'] = [f'Invalid pk "{item["object_id"]}" - object does not exist.']
+
+        parent = None
+        if item.get('parent_index') is not None:
+            if item.get('parent') is not None:
+                error['parent_index'] = ['Give either parent or parent_index.']
+            elif item['parent_index'] >= index:
+                error['parent_index'] = ['Must refer to an earlier comment of the batch.']
+            else:
+                parent = items[item['parent_index']]
+                parent = {'content_type_id': parent['content_type'], 'object_id': parent['object_id'],
+                          'level': levels[item['parent_index']]}
+        elif item.get('parent') is not None:
+            parent = parents.get(item['parent'])
+            if parent is None:
+                error['parent'] = [f'Invalid pk "{item["parent"]}" - object does not exist.']
+        levels.append(0 if parent is None else parent['level'] + 1)
+        if parent is not None:
+            if levels[-1] > settings.COMMENTS_MAX_LEVEL:
+                error['parent_index' if item.get('parent_index') is not None else 'parent'] = [
+                    f'Replies can be nested at most {settings.COMMENTS_MAX_LEVEL} levels deep.']
+            if item['content_type'] != parent['content_type_id']:
+                error['content_type'] = ['Must be same with parent comment\'s content_type']
+            if item['object_id'] != parent['object_id']:
+                error['object_id'] = ['Must be same with parent comment\'s object_id']
+    return parents, errors
+
+
+def _number_tree(roots, children):
+    """
+    Set ``lft``/``rght`` of new trees, children in batch order.
+    """
+    for root in roots:
+        counter = 1
+        stack = [(root, False)]
+        while stack:
+            node, done = stack.pop()
+            if done:
+                node.rght = counter
+            else:
+                node.lft = counter
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(children[id(node)]))
+            counter += 1
+
+
+def comment_data(comment):
+    """
+    Event payload of a comment created in bulk, the fields of the API but its ``url``.
+    """
+    return {
+        'id': comment.pk,
+        'user': comment.user_id,
+        'text': comment.text,
+        'created': DateTimeField().to_representation(comment.created),
+        'parent': comment.parent_id,
+        'content_type': comment.content_type_id,
+        'object_id': comment.object_id,
+        'level': comment.level,
+        'reply_count': comment.reply_count,
+    }
+
+
+def create_comments(items, parents, batch_size=1000):
+    """
+    Insert checked ``items`` with ``bulk_create``, one statement per nesting
+    level of the batch and ``batch_size`` rows. Existing trees that got
+    replies are rebuilt once at the end, new trees are numbered up front.
+
+    Cached responses are invalidated and subscribers told about every new
+    comment once the transaction commits, whatever path the batch came in by.
+    """
+    storage = tree_storage()
+    comments = []
+    children = defaultdict(list)
+    waves = defaultdict(list)
+    depth = []
+    new_roots = []
+    affected_trees = set()
+
+    with transaction.atomic():
+        lock_tree_ids()
+        next_tree_id = (Comment.objects.aggregate(last=Max('tree_id'))['last'] or 0) + 1
+        for item in items:
+            comment = Comment(user_id=item['user'], text=item['text'], content_type_id=item['content_type'],
+                              object_id=item['object_id'], lft=1, rght=2)
+            if item.get('parent_index') is not None:
+                parent = comments[item['parent_index']]
+                comment.tree_id, comment.level = parent.tree_id, parent.level + 1
+                children[id(parent)].append(comment)
+                depth.append(depth[item['parent_index']] + 1)
+            elif item.get('parent') is not None:
+                parent = parents[item['parent']]
+                comment.parent_id = parent['pk']
+                comment.tree_id, comment.level = parent['tree_id'], parent['level'] + 1
+                affected_trees.add(comment.tree_id)
+                depth.append(0)
+            else:
+                comment.tree_id, comment.level = next_tree_id, 0
+                next_tree_id += 1
+                new_roots.append(comment)
+                depth.append(0)
+            comments.append(comment)
+            waves[depth[-1]].append((item, comment))
+        _number_tree(new_roots, children)
+        for comment in comments:
+            comment.reply_count = len(children[id(comment)])
+
+        for wave in range(len(waves)):
+            for item, comment in waves[wave]:
+                if item.get('parent_index') is not None:
+                    comment.parent_id = comments[item['parent_index']].pk
+            batch = [comment for _, comment in waves[wave]]
+            if connection.features.can_return_ids_from_bulk_insert:
+                Comment.objects.bulk_create(batch, batch_size=batch_size)
+            else:
+                for comment in batch:
+                    # Tree fields are set, so MPTT inserts the row as is
+                    comment.save()
+
+        if storage.name == 'path':
+            paths = {}
+            for comment in comments:
+                parent_path = paths.get(comment.parent_id)
+                if parent_path is None and comment.parent_id is not None:
+                    parent_path = parents[comment.parent_id]['path']
+                comment.path = paths[comment.pk] = (parent_path or '') + path_segment(comment.pk)
+            for start in range(0, len(comments), batch_size):
+                chunk = comments[start:start + batch_size]
+                Comment.objects.filter(pk__in=[c.pk for c in chunk]).update(path=Case(
+                    *[When(pk=c.pk, then=Value(c.path)) for c in chunk], output_field=TextField()))
+
+        for (ct_id, object_id), count in Counter((c.content_type_id, c.object_id) for c in comments).items():
+            CommentCounter.objects.add(ct_id, object_id, count)
+        for parent_id, count in Counter(c.parent_id for c in comments if c.parent_id in parents).items():
+            Comment.objects.filter(pk=parent_id).update(reply_count=F('reply_count') + count)
+
+        if storage.name == 'mptt':
+            for tree_id in affected_trees:
+                Comment.objects.partial_rebuild(tree_id)
+
+        invalidate_comments(comments)
+        for comment in comments:
+            publish_comment(comment, comment_data(comment), COMMENT_CREATED)
+    return comments
@@ -0,0 +1,112 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+
+from core.utils import TTLCache
+
+# In-process tier in front of the shared cache. Keys hold the versions of
+# everything the response depends on, so entries never need invalidating.
+local_responses = TTLCache(settings.COMMENTS_RESPONSE_CACHE_LOCAL_SIZE, settings.COMMENTS_RESPONSE_CACHE_TTL)
+
+ALL_COMMENTS = 'comments:v:all'
+
+
+def shared_cache():
+    return caches[settings.COMMENTS_RESPONSE_CACHE]
+
+
+def object_version_key(content_type_id, object_id):
+    return f'comments:v:o:{content_type_id}:{object_id}'
+
+
+def comment_version_key(pk):
+    return f'comments:v:c:{pk}'
+
+
+def get_versions(keys):
+    """
+    Current versions of ``keys``. Missing ones start at the current time, so
+    that a version lost by eviction never comes back to an old value.
+    """
+    cache = shared_cache()
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, int(time.time() * 1000), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_versions(keys):
+    cache = shared_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, int(time.time() * 1000), timeout=None)
+
+
+def invalidate_comments(comments):
+    """
+    Once the transaction commits, outdate cached responses showing ``comments``:
+    the listings of their objects, the comments and their parents (reply counts).
+    """
+    keys = {ALL_COMMENTS}
+    for comment in comments:
+        keys.add(object_version_key(comment.content_type_id, comment.object_id))
+        if comment.pk is not None:
+            keys.add(comment_version_key(comment.pk))
+        if comment.parent_id is not None:
+            keys.add(comment_version_key(comment.parent_id))
+    keys = sorted(keys)
+    transaction.on_commit(lambda: bump_versions(keys))
+
+
+class CachedResponseMixin:
+    """
+    Read-through cache of ``list`` and ``retrieve`` response data, keyed by
+    the normalized query and the versions of the objects shown.
+    """
+
+    def list(self, request, *args, **kwargs):
+        params = request.query_params
+        try:
+            version_key = object_version_key(int(params['content_type']), int(params['object_id']))
+        except (KeyError, ValueError):
+            version_key = ALL_COMMENTS
+        return self.cached_response(request, version_key, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request, comment_version_key(kwargs[self.lookup_field]), super().retrieve,
+                                    *args, **kwargs)
+
+    def cached_response(self, request, version_key, view, *args, **kwargs):
+        query = sorted((key, value) for key, values in request.query_params.lists() if key != 'format'
+                       for value in values)
+        version, = get_versions([version_key])
+        if version is None:
+            # The shared cache is unavailable, entries could not be invalidated
+            return view(request, *args, **kwargs)
+        raw_key = repr((self.action, request.build_absolute_uri(request.path), query, version_key, version))
+        key = 'comments:r:' + hashlib.sha1(raw_key.encode('utf-8')).hexdigest()
+
+        data = local_responses.get(key)
+        if data is None:
+            data = shared_cache().get(key)
+            if data is not None:
+                local_responses.set(key, data)
+        if data is not None:
+            response = Response(data)
+            response['X-Cache'] = 'hit'
+            return response
+
+        response = view(request, *args, **kwargs)
+        if response.status_code == 200:
+            shared_cache().set(key, response.data, settings.COMMENTS_RESPONSE_CACHE_TTL)
+            local_responses.set(key, response.data)
+        response['X-Cache'] = 'miss'
+        return response
@@ -1,32 +1,43 @@
+import asyncio
+from collections import OrderedDict, defaultdict
+
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
-from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
-from django.core.exceptions import ObjectDoesNotExist
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, JsonWebsocketConsumer
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from rest_framework import serializers
 
-from comments.models import Comment, Post
+from comments.events import group_name
+from comments.registry import subscribable
+from comments.validation import ContentTypeField
+from core import metrics
+
+
+SUBSCRIBE = 'subscribe'
+UNSUBSCRIBE = 'unsubscribe'
+# Close code for clients that do not keep up with their updates
+CLOSE_TOO_SLOW = 4008
 
 
 class CommonObjectSerializer(serializers.Serializer):
-    SUBSCRIBE = 'subscribe'
-    UNSUBSCRIBE = 'unsubscribe'
+    SUBSCRIBE = SUBSCRIBE
+    UNSUBSCRIBE = UNSUBSCRIBE
 
-    content_type = serializers.ChoiceField([c.pk for c in ContentType.objects.filter(
-        model__in=[Post._meta.model_name, User._meta.model_name, Comment._meta.model_name]
-    )])
-    object_id = serializers.IntegerField()
+    content_type = ContentTypeField(subscribable)
+    # Integer for most objects, UUID for exports
+    object_id = serializers.CharField(max_length=36)
     action = serializers.ChoiceField([SUBSCRIBE, UNSUBSCRIBE])
 
     class Meta:
         fields = ('content_type', 'object_id')
 
     def validate(self, data):
-        try:
-            ct = ContentType.objects.get_for_id(data['content_type'])
-            ct.get_object_for_this_type(pk=data['object_id'])
-        except ObjectDoesNotExist as e:
-            raise serializers.ValidationError(e)
+        resolver = subscribable.resolver(data['content_type'].pk)
+        if not resolver.exists(data['object_id']):
+            raise serializers.ValidationError(f'{resolver.model.__name__} matching query does not exist.')
+        # As events name it, e.g. "7" for "07"
+        data['object_id'] = resolver.to_pk(data['object_id'])
         return data
 
 
@@ -47,14 +58,152 @@ class ObjectUpdateConsumer(JsonWebsocketConsumer):
         """
         serializer = CommonObjectSerializer(data=content)
         if serializer.is_valid():
-            ct, obj_id = serializer.data['content_type'], serializer.data['object_id']
-            if serializer.data['action'] == serializer.SUBSCRIBE:
+            data = serializer.validated_data
+            if data['action'] == serializer.SUBSCRIBE:
                 action = async_to_sync(self.channel_layer.group_add)
-            elif serializer.data['action'] == serializer.UNSUBSCRIBE:
+            elif data['action'] == serializer.UNSUBSCRIBE:
                 action = async_to_sync(self.channel_layer.group_discard)
-            action(f'{ct}.{obj_id}', self.channel_name)
+            action(group_name(data['content_type'].pk, data['object_id']), self.channel_name)
         else:
             self.send_json({'error': serializer.errors})
 
     def object_updated(self, event):
         self.send_json(event)
+
+    comment_created = comment_deleted = object_updated
+
+
+class ObjectRefSerializer(serializers.Serializer):
+    content_type = ContentTypeField(subscribable)
+    object_id = serializers.CharField(max_length=36)
+
+
+class SubscriptionSerializer(ObjectRefSerializer):
+    action = serializers.ChoiceField([SUBSCRIBE, UNSUBSCRIBE])
+
+
+class BatchSubscriptionSerializer(serializers.Serializer):
+    action = serializers.ChoiceField([SUBSCRIBE, UNSUBSCRIBE])
+    objects = ObjectRefSerializer(many=True)
+
+    def validate_objects(self, value):
+        if len(value) > settings.COMMENTS_WS_MAX_BATCH:
+            raise serializers.ValidationError(f'At most {settings.COMMENTS_WS_MAX_BATCH} objects per message.')
+        return value
+
+
+def find_objects(refs, check_exists=True):
+    """
+    Split ``refs`` into group names and errors. Existence is checked with one
+    ``IN`` query per content type.
+    """
+    by_type = defaultdict(dict)
+    errors = []
+    for ref in refs:
+        resolver = subscribable.resolver(ref['content_type'].pk)
+        try:
+            pk = resolver.to_pk(ref['object_id'])
+        except ValidationError as e:
+            errors.append({'content_type': ref['content_type'].pk, 'object_id': ref['object_id'], 'error': e.messages})
+            continue
+        by_type[resolver][pk] = ref
+
+    groups = []
+    for resolver, refs_by_pk in by_type.items():
+        found = resolver.existing(list(refs_by_pk)) if check_exists else refs_by_pk
+        for pk, ref in refs_by_pk.items():
+            if pk in found:
+                groups.append(group_name(resolver.content_type.pk, pk))
+            else:
+                errors.append({'content_type': resolver.content_type.pk, 'object_id': ref['object_id'],
+                               'error': [f'{resolver.model.__name__} matching query does not exist.']})
+    return groups, errors
+
+
+send_queue_depth = metrics.gauge('comments_ws_send_queue_depth',
+                                 'Events waiting to be sent to WebSocket clients')
+slow_clients = metrics.counter('comments_ws_slow_clients_closed_total',
+                               'WebSocket clients closed for falling behind')
+
+
+class AsyncObjectUpdateConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Asynchronous ``ObjectUpdateConsumer`` also accepting batches:
+    ``{"action": "subscribe", "objects": [{"content_type": 1, "object_id": 2}, ...]}``.
+
+    Events go through a per-connection outbox sent by a separate task, so a
+    slow client never holds up the channel layer inbox. A queued update of
+    an object is replaced by a newer one, clients with more than
+    ``COMMENTS_WS_SEND_QUEUE_SIZE`` events waiting are closed with
+    ``CLOSE_TOO_SLOW``.
+    """
+    outbox = None
+    writer = None
+
+    async def connect(self):
+        if self.scope["user"].is_anonymous:
+            await self.close()
+            return
+        # Messages are validated on the event loop, content types must be known by then
+        await database_sync_to_async(subscribable.ids)()
+        self.outbox = OrderedDict()
+        self.outbox_ready = asyncio.Event()
+        self.writer = asyncio.ensure_future(self.send_outbox())
+        await self.accept()
+
+    async def disconnect(self, code):
+        if self.writer is not None:
+            self.writer.cancel()
+            await asyncio.wait([self.writer])
+        if self.outbox:
+            send_queue_depth.dec(len(self.outbox))
+        self.outbox = None
+
+    async def send_outbox(self):
+        while True:
+            await self.outbox_ready.wait()
+            while self.outbox:
+                _, event = self.outbox.popitem(last=False)
+                send_queue_depth.dec()
+                await self.send_json(event)
+            self.outbox_ready.clear()
+
+    async def enqueue(self, key, event):
+        if self.outbox is None:
+            return
+        if key not in self.outbox:
+            if len(self.outbox) >= settings.COMMENTS_WS_SEND_QUEUE_SIZE:
+                slow_clients.inc()
+                send_queue_depth.dec(len(self.outbox))
+                self.outbox = None
+                return await self.close(code=CLOSE_TOO_SLOW)
+            send_queue_depth.inc()
+        self.outbox[key] = event
+        self.outbox_ready.set()
+
+    async def receive_json(self, content, **kwargs):
+        batch = isinstance(content, dict) and 'objects' in content
+        serializer = (BatchSubscriptionSerializer if batch else SubscriptionSerializer)(data=content)
+        if not serializer.is_valid():
+            return await self.send_json({'error': serializer.errors})
+        action = serializer.validated_data['action']
+        refs = serializer.validated_data['objects'] if batch else [serializer.validated_data]
+
+        # Objects deleted meanwhile can still be unsubscribed from
+        groups, errors = await database_sync_to_async(find_objects)(refs, check_exists=action == SUBSCRIBE)
+        if action == SUBSCRIBE:
+            method = self.channel_layer.group_add
+        else:
+            method = self.channel_layer.group_discard
+        await asyncio.gather(*(method(group, self.channel_name) for group in groups))
+        if errors:
+            await self.send_json({'error': errors})
+
+    async def object_updated(self, event):
+        await self.enqueue((event['content_type'], event['object_id']), event)
+
+    async def comment_created(self, event):
+        # Never replaced, every comment is sent
+        await self.enqueue((event['type'], event['content_type'], event['object_id'], event['data']['id']), event)
+
+    comment_deleted = comment_created
@@ -0,0 +1,173 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from core import metrics
+
+OBJECT_UPDATED = 'object.updated'
+COMMENT_CREATED = 'comment.created'
+COMMENT_DELETED = 'comment.deleted'
+
+log = logging.getLogger(__name__)
+
+group_send_latency = metrics.histogram('comments_group_send_seconds', 'Latency of channel layer group sends')
+group_send_failures = metrics.counter('comments_group_send_failures_total', 'Channel layer group sends that failed')
+fanout_delay = metrics.histogram('comments_fanout_delay_seconds',
+                                 'Time from commit until an event is sent to its group, coalescing window included')
+fanout_pending = metrics.gauge('comments_fanout_pending_events', 'Events waiting in the coalescing window')
+fanout_coalesced = metrics.counter('comments_fanout_coalesced_total', 'Events replaced by a later one with the same key')
+
+
+def group_name(content_type_id, object_id):
+    return f'{content_type_id}.{object_id}'
+
+
+def object_key(instance):
+    """
+    Content type id and object id subscribers of ``instance`` use.
+    """
+    ct = ContentType.objects.get_for_model(instance.__class__)
+    return ct.pk, instance.pk if isinstance(instance.pk, int) else str(instance.pk)
+
+
+def make_event(content_type_id, object_id, data, event_type=OBJECT_UPDATED):
+    """
+    Group name and message telling subscribers of the object about ``data``.
+    """
+    return group_name(content_type_id, object_id), {
+        "type": event_type,
+        "content_type": content_type_id,
+        "object_id": object_id,
+        "data": data
+    }
+
+
+async def group_send(group, message):
+    """
+    ``group_send`` of the channel layer, timed and counted by event type.
+    """
+    started = time.perf_counter()
+    try:
+        await get_channel_layer().group_send(group, message)
+    except Exception:
+        group_send_failures.inc(type=message['type'])
+        raise
+    group_send_latency.observe(time.perf_counter() - started, type=message['type'])
+
+
+def publish(instance, data, event_type=OBJECT_UPDATED):
+    """
+    Send ``data`` to everybody subscribed to ``instance`` right away.
+    """
+    group, message = make_event(*object_key(instance), data, event_type)
+    async_to_sync(group_send)(group, message)
+
+
+class Publisher:
+    """
+    Background fan-out of events, running its own event loop in a daemon thread.
+
+    Events are coalesced by key: the first one for a key is sent ``window``
+    seconds later, replaced by any event with the same key that comes in
+    meanwhile, so bursts of updates of one object reach subscribers once,
+    with the latest state.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='comments-publisher', daemon=True).start()
+                self.loop = loop
+        return self.loop
+
+    def send(self, key, group, message):
+        self.start().call_soon_threadsafe(self._schedule, key, group, message, time.monotonic())
+
+    def _schedule(self, key, group, message, queued):
+        if key in self.pending:
+            # The delay counts from the first event of the key
+            queued = self.pending[key][2]
+            fanout_coalesced.inc()
+        else:
+            asyncio.get_event_loop().call_later(self.window, self._flush, key)
+            fanout_pending.inc()
+        self.pending[key] = (group, message, queued)
+
+    def _pop(self, key):
+        fanout_pending.dec()
+        return self.pending.pop(key)
+
+    def _flush(self, key):
+        if key in self.pending:
+            asyncio.ensure_future(self._group_send(*self._pop(key)))
+
+    async def _group_send(self, group, message, queued):
+        try:
+            await group_send(group, message)
+        except Exception:
+            log.warning('Could not publish %s to %s', message['type'], group, exc_info=True)
+        else:
+            fanout_delay.observe(time.monotonic() - queued, type=message['type'])
+
+    def stop(self):
+        """
+        Send what is still pending and stop the loop.
+        """
+        async def drain():
+            sends = [self._group_send(*self._pop(key)) for key in list(self.pending)]
+            await asyncio.gather(*sends)
+
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(drain(), loop).result(timeout=5)
+            loop.call_soon_threadsafe(loop.stop)
+
+
+publisher = Publisher(settings.COMMENTS_FANOUT_WINDOW)
+atexit.register(publisher.stop)
+
+
+def publish_on_commit(instance, data, event_type=OBJECT_UPDATED, key=None):
+    """
+    Hand the event over to the background publisher once the current
+    transaction commits. Events of the same type and ``key`` to the same
+    group are coalesced within ``COMMENTS_FANOUT_WINDOW`` seconds.
+    """
+    publish_to_on_commit(*object_key(instance), data, event_type, key)
+
+
+def publish_to_on_commit(content_type_id, object_id, data, event_type=OBJECT_UPDATED, key=None):
+    """
+    ``publish_on_commit`` for an object known only by its content type and id.
+    """
+    group, message = make_event(content_type_id, object_id, data, event_type)
+    key = (group, event_type, key)
+    transaction.on_commit(lambda: publisher.send(key, group, message))
+
+
+def publish_comment(comment, data, event_type):
+    """
+    Tell subscribers of the commented object and of the parent comment,
+    with the comment itself in the payload.
+    """
+    # Keyed by comment, so that new comments are never coalesced together
+    publish_to_on_commit(comment.content_type_id, comment.object_id, data, event_type, key=data['id'])
+    if comment.parent_id is not None:
+        comment_type = ContentType.objects.get_for_model(comment)
+        publish_to_on_commit(comment_type.pk, comment.parent_id, data, event_type, key=data['id'])
@@ -1,10 +1,23 @@
+import array
+import csv
 import enum
+import io
 import json
-from collections import Generator
+import re
+import struct
+import sys
+import zlib
+from collections.abc import Generator
+from itertools import islice
 
 from django.utils import six
 from django.utils.encoding import smart_text
-from django.utils.xmlutils import SimplerXMLGenerator
+from django.utils.xmlutils import SimplerXMLGenerator, UnserializableContentError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class _GeneratorListWrapper(list):
@@ -19,11 +32,19 @@ class _GeneratorListWrapper(list):
         return 1
 
 
+def iterdump_json_part(file, data):
+    encoder = json.JSONEncoder()
+    for i, item in enumerate(data):
+        if i:
+            file.write(encoder.item_separator.encode('utf-8'))
+        for chunk in encoder.iterencode(item):
+            file.write(chunk.encode('utf-8'))
+
+
 def iterdump_json(file, data):
-    if isinstance(data, Generator):
-        data = _GeneratorListWrapper(data)
-    for chunk in json.JSONEncoder().iterencode(data):
-        file.write(chunk.encode('utf-8'))
+    file.write(b'[')
+    iterdump_json_part(file, data)
+    file.write(b']')
 
 
 def _to_xml(xml, data):
@@ -45,7 +66,11 @@ def _to_xml(xml, data):
         xml.characters(smart_text(data))
 
 
-def iterdump_xml(file, data):
+def iterdump_xml_sax(file, data):
+    """
+    Reference XML writer on top of ``SimplerXMLGenerator``; :func:`iterdump_xml`
+    produces the same bytes much faster.
+    """
     if isinstance(data, Generator):
         data = _GeneratorListWrapper(data)
 
@@ -61,17 +86,414 @@ def iterdump_xml(file, data):
     xml.endDocument()
 
 
+_XML_HEAD = '<?xml version="1.0" encoding="utf-8"?>\n'
+_XML_CONTROL_CHARS = re.compile(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]')
+_XML_BUFFER_ITEMS = 4096
+
+
+def _xml_text(value):
+    text = value if isinstance(value, str) else smart_text(value)
+    if _XML_CONTROL_CHARS.search(text):
+        raise UnserializableContentError('Control characters are not supported in XML 1.0')
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def _xml_nested(append, data):
+    # Same layout as _to_xml, only reached for nested values.
+    if isinstance(data, (list, tuple)):
+        for item in data:
+            append('<list-item>')
+            _xml_nested(append, item)
+            append('</list-item>')
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            append(f'<{key}>')
+            _xml_nested(append, value)
+            append(f'</{key}>')
+    elif data is not None:
+        append(_xml_text(data))
+
+
+def iterdump_xml_part(file, data):
+    """
+    Write ``data`` items as ``<list-item>`` elements. Flat dict items take a
+    loop with cached tags and escaping done on whole values; output goes out
+    in large encoded chunks.
+    """
+    buffer = []
+    append = buffer.append
+    tags = {}
+    for count, item in enumerate(data, 1):
+        append('<list-item>')
+        if isinstance(item, dict):
+            for key, value in item.items():
+                try:
+                    start, end = tags[key]
+                except KeyError:
+                    start, end = tags[key] = f'<{key}>', f'</{key}>'
+                append(start)
+                if value is None:
+                    pass
+                elif type(value) is int:
+                    append(str(value))
+                elif isinstance(value, (dict, list, tuple)):
+                    _xml_nested(append, value)
+                else:
+                    append(_xml_text(value))
+                append(end)
+        else:
+            _xml_nested(append, item)
+        append('</list-item>')
+        if not count % _XML_BUFFER_ITEMS:
+            file.write(''.join(buffer).encode('utf-8', 'xmlcharrefreplace'))
+            buffer.clear()
+    if buffer:
+        file.write(''.join(buffer).encode('utf-8', 'xmlcharrefreplace'))
+
+
+def iterdump_xml(file, data):
+    file.write(f'{_XML_HEAD}<root>'.encode('utf-8'))
+    iterdump_xml_part(file, data)
+    file.write(b'</root>')
+
+
+def iterdump_jsonl(file, data):
+    encode = json.JSONEncoder().encode
+    for item in data:
+        file.write(encode(item).encode('utf-8'))
+        file.write(b'\n')
+
+
+class _TextWriter:
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, text):
+        self.file.write(text.encode('utf-8'))
+
+
+def iterdump_csv(file, data):
+    """
+    CSV with a header row taken from the keys of the first item; ``None``
+    becomes an empty field. Nothing at all is written for empty ``data``.
+    """
+    writer = None
+    for item in data:
+        if writer is None:
+            writer = csv.writer(_TextWriter(file))
+            writer.writerow(item.keys())
+        writer.writerow(item.values())
+
+
+COLUMNAR_MAGIC = b'CCOL\x01'
+COLUMNAR_BLOCK_ROWS = 4096
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def _le_bytes(values):
+    if not _LITTLE_ENDIAN:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _encode_column(name, values):
+    """
+    One column of a block: name, type tag, null bitmap and values. Columns
+    holding only ints are stored as int64, anything else as utf-8 strings
+    addressed by uint32 end offsets.
+    """
+    name = name.encode('utf-8')
+    out = [struct.pack('<H', len(name)), name]
+    nulls = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value is None:
+            nulls[i >> 3] |= 1 << (i & 7)
+    present = [value for value in values if value is not None]
+    if all(type(value) is int and _INT64_MIN <= value <= _INT64_MAX for value in present):
+        out += [b'i', nulls, _le_bytes(array.array('q', [0 if value is None else value for value in values]))]
+    else:
+        strings = [b'' if value is None else smart_text(value).encode('utf-8') for value in values]
+        offsets, end = array.array('I'), 0
+        for string in strings:
+            end += len(string)
+            offsets.append(end)
+        out += [b's', nulls, _le_bytes(offsets), b''.join(strings)]
+    return b''.join(out)
+
+
+def iterdump_columnar_part(file, data):
+    data = iter(data)
+    while True:
+        rows = list(islice(data, COLUMNAR_BLOCK_ROWS))
+        if not rows:
+            break
+        names = list(rows[0].keys())
+        payload = [struct.pack('<IH', len(rows), len(names))]
+        payload += [_encode_column(name, [row.get(name) for row in rows]) for name in names]
+        block = zlib.compress(b''.join(payload))
+        file.write(struct.pack('<I', len(block)))
+        file.write(block)
+
+
+def iterdump_columnar(file, data):
+    """
+    Compact columnar binary format: ``COLUMNAR_MAGIC``, then zlib-compressed
+    blocks of up to ``COLUMNAR_BLOCK_ROWS`` rows each prefixed by its uint32
+    length, then a zero length. Read it back with :func:`iterload_columnar`.
+    """
+    file.write(COLUMNAR_MAGIC)
+    iterdump_columnar_part(file, data)
+    file.write(struct.pack('<I', 0))
+
+
+def _read_exactly(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated columnar file')
+    return data
+
+
+def iterload_columnar(file):
+    if file.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError('Not a columnar export')
+    while True:
+        size, = struct.unpack('<I', _read_exactly(file, 4))
+        if not size:
+            return
+        block = memoryview(zlib.decompress(_read_exactly(file, size)))
+        rows, columns_count = struct.unpack_from('<IH', block)
+        pos = 6
+        columns = []
+        for _ in range(columns_count):
+            name_size, = struct.unpack_from('<H', block, pos)
+            name = bytes(block[pos + 2:pos + 2 + name_size]).decode('utf-8')
+            pos += 2 + name_size
+            kind = bytes(block[pos:pos + 1])
+            nulls = block[pos + 1:pos + 1 + (rows + 7) // 8]
+            pos += 1 + len(nulls)
+            values = array.array('q' if kind == b'i' else 'I')
+            values.frombytes(block[pos:pos + rows * values.itemsize])
+            if not _LITTLE_ENDIAN:
+                values.byteswap()
+            pos += rows * values.itemsize
+            if kind == b's':
+                start, strings = 0, []
+                for end in values:
+                    strings.append(bytes(block[pos + start:pos + end]).decode('utf-8'))
+                    start = end
+                pos += start
+                values = strings
+            columns.append((name, [None if nulls[i >> 3] & (1 << (i & 7)) else values[i] for i in range(rows)]))
+        for i in range(rows):
+            yield {name: values[i] for name, values in columns}
+
+
+class _CompressedWriter:
+    def __init__(self, file, compressor):
+        self.file = file
+        self.compressor = compressor
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.file.write(compressed)
+
+    def close(self):
+        self.file.write(self.compressor.flush())
+
+
+def _gzip_compressor():
+    return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+
+
+def _zstd_compressor():
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def _compressed(iterdump_function, compressor_factory):
+    def iterdump_compressed(file, data):
+        writer = _CompressedWriter(file, compressor_factory())
+        iterdump_function(writer, data)
+        writer.close()
+
+    return iterdump_compressed
+
+
+def _compress_chunks(chunks, compressor_factory):
+    compressor = compressor_factory()
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
 class Format(enum.Enum):
     xml = 'xml'
     json = 'json'
+    jsonl = 'jsonl'
+    csv = 'csv'
+    jsonl_gz = 'jsonl.gz'
+    csv_gz = 'csv.gz'
+    jsonl_zst = 'jsonl.zst'
+    csv_zst = 'csv.zst'
+    columnar = 'columnar'
+
 
+CONTENT_TYPES = {
+    Format.xml: 'application/xml',
+    Format.json: 'application/json',
+    Format.jsonl: 'application/x-ndjson',
+    Format.csv: 'text/csv',
+    Format.jsonl_gz: 'application/gzip',
+    Format.csv_gz: 'application/gzip',
+    Format.jsonl_zst: 'application/zstd',
+    Format.csv_zst: 'application/zstd',
+    Format.columnar: 'application/octet-stream',
+}
 
 _AVAILABLE_FORMATS = {
     Format.json: iterdump_json,
-    Format.xml: iterdump_xml
+    Format.xml: iterdump_xml,
+    Format.jsonl: iterdump_jsonl,
+    Format.csv: iterdump_csv,
+    Format.jsonl_gz: _compressed(iterdump_jsonl, _gzip_compressor),
+    Format.csv_gz: _compressed(iterdump_csv, _gzip_compressor),
+    Format.columnar: iterdump_columnar,
 }
+if zstandard is not None:
+    _AVAILABLE_FORMATS.update({
+        Format.jsonl_zst: _compressed(iterdump_jsonl, _zstd_compressor),
+        Format.csv_zst: _compressed(iterdump_csv, _zstd_compressor),
+    })
+
+_COPY_CHUNK_SIZE = 64 * 1024
+
+
+def _read_chunks(file):
+    return iter(lambda: file.read(_COPY_CHUNK_SIZE), b'')
+
+
+def _joiner(head, separator, tail):
+    """
+    Stitch parts by wrapping them in ``head`` / ``tail`` and putting
+    ``separator`` between the non-empty ones.
+    """
+    def iterjoin(parts):
+        yield head
+        empty = True
+        for part in parts:
+            chunks = _read_chunks(part)
+            first_chunk = next(chunks, None)
+            if first_chunk is None:
+                continue
+            if not empty:
+                yield separator
+            empty = False
+            yield first_chunk
+            yield from chunks
+        yield tail
+
+    return iterjoin
+
+
+def _iterjoin_csv(parts):
+    """
+    Keep the header row of the first non-empty part only.
+    """
+    header_written = False
+    for part in parts:
+        header = part.readline()
+        if not header:
+            continue
+        if not header_written:
+            header_written = True
+            yield header
+        yield from _read_chunks(part)
+
+
+def _compressed_joiner(iterjoin, compressor_factory):
+    def iterjoin_compressed(parts):
+        return _compress_chunks(iterjoin(parts), compressor_factory)
+
+    return iterjoin_compressed
+
+
+# Formats that can be written as separate parts and stitched afterwards:
+# part writer and a generator of the stitched document's chunks. Parts of
+# compressed formats are written uncompressed and compressed when stitched.
+_iterjoin_jsonl = _joiner(b'', b'', b'')
+_PART_FORMATS = {
+    Format.json: (iterdump_json_part, _joiner(b'[', b', ', b']')),
+    Format.xml: (iterdump_xml_part, _joiner(f'{_XML_HEAD}<root>'.encode('utf-8'), b'', b'</root>')),
+    Format.jsonl: (iterdump_jsonl, _iterjoin_jsonl),
+    Format.csv: (iterdump_csv, _iterjoin_csv),
+    Format.jsonl_gz: (iterdump_jsonl, _compressed_joiner(_iterjoin_jsonl, _gzip_compressor)),
+    Format.csv_gz: (iterdump_csv, _compressed_joiner(_iterjoin_csv, _gzip_compressor)),
+    Format.columnar: (iterdump_columnar_part, _joiner(COLUMNAR_MAGIC, b'', struct.pack('<I', 0))),
+}
+if zstandard is not None:
+    _PART_FORMATS.update({
+        Format.jsonl_zst: (iterdump_jsonl, _compressed_joiner(_iterjoin_jsonl, _zstd_compressor)),
+        Format.csv_zst: (iterdump_csv, _compressed_joiner(_iterjoin_csv, _zstd_compressor)),
+    })
+
+
+def is_available(format_type):
+    return Format(format_type) in _AVAILABLE_FORMATS
+
+
+def content_type(format_type):
+    return CONTENT_TYPES[Format(format_type)]
 
 
 def iterdump(format_type, file, data):
     format_type = Format(format_type)
     return _AVAILABLE_FORMATS[format_type](file, data)
+
+
+def iterdump_part(format_type, file, data):
+    """
+    Write ``data`` as one part of a document, to be stitched by :func:`join_parts`.
+    """
+    format_type = Format(format_type)
+    return _PART_FORMATS[format_type][0](file, data)
+
+
+def join_parts(format_type, file, parts):
+    """
+    Write a complete document made of ``parts`` (binary file objects)
+    written by :func:`iterdump_part`, in the given order.
+    """
+    format_type = Format(format_type)
+    for chunk in _PART_FORMATS[format_type][1](parts):
+        file.write(chunk)
+
+
+def iterdump_chunks(format_type, data, chunk_size):
+    """
+    Generate the document for ``data`` as byte chunks, dumping ``chunk_size``
+    items at a time, e.g. for a streaming response.
+    """
+    format_type = Format(format_type)
+    dump_part, iterjoin = _PART_FORMATS[format_type]
+
+    def parts():
+        items = iter(data)
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                return
+            part = io.BytesIO()
+            dump_part(part, chunk)
+            part.seek(0)
+            yield part
+
+    return iterjoin(parts())
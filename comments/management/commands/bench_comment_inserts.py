@@ -0,0 +1,52 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+
+from comments.models import Comment, Post
+
+
+class Command(BaseCommand):
+    help = 'Compare reply insert latency of the comment tree storages against thread size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+        parser.add_argument('--inserts', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        user = User.objects.order_by('pk').first()
+        self.stdout.write(f'{"thread":>8} {"storage":>8} {"mean ms":>9} {"p95 ms":>9}')
+        for size in options['sizes']:
+            # Everything is rolled back, each size starts from the same database
+            with transaction.atomic():
+                self.bench_thread(user, size, options['inserts'], random.Random(options['seed']))
+                transaction.set_rollback(True)
+
+    def bench_thread(self, user, size, inserts, rnd):
+        post = Post.objects.create(text='bench')
+        with override_settings(COMMENTS_TREE_STORAGE='path'):
+            ids = [Comment.objects.create(user=user, text='root', content_object=post).pk]
+            for i in range(size - 1):
+                parent = Comment.objects.get(pk=rnd.choice(ids))
+                ids.append(Comment.objects.create(user=user, text='bench', content_object=post, parent=parent).pk)
+        Comment.objects.partial_rebuild(Comment.objects.get(pk=ids[0]).tree_id)
+
+        # MPTT first, path inserts leave lft/rght of the thread behind
+        for name in ('mptt', 'path'):
+            timings = []
+            with override_settings(COMMENTS_TREE_STORAGE=name):
+                for _ in range(inserts):
+                    # Replies to early comments make MPTT shift most of the thread
+                    parent = Comment.objects.get(pk=rnd.choice(ids[:max(1, len(ids) // 10)]))
+                    comment = Comment(user=user, text='reply', content_object=post, parent=parent)
+                    started = time.perf_counter()
+                    comment.save()
+                    timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(f'{size:>8} {name:>8} {statistics.mean(timings):>9.2f} {p95:>9.2f}')
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+
+from comments.events import group_name
+from comments.export import Format
+from comments.models import Comment, CommentCounter, CommentsHistory, Post
+
+OPERATIONS = ('list', 'retrieve', 'thread', 'create', 'update', 'update_fanout', 'export')
+
+
+def percentile(timings, fraction):
+    """
+    Nearest-rank percentile of sorted ``timings``.
+    """
+    return timings[min(len(timings) - 1, max(0, int(round(fraction * len(timings))) - 1))]
+
+
+def summary(timings, elapsed):
+    timings = sorted(timings)
+    return {
+        'count': len(timings),
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.mean(timings) * 1000, 3),
+        'throughput': round(len(timings) / max(elapsed, 1e-9), 1),
+    }
+
+
+class Command(BaseCommand):
+    help = ('Measure p50/p99 latency and throughput of the comment API and exports against the current '
+            'database (see generate_comments), write the results as JSON and compare them with a baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+        parser.add_argument('--requests', type=int, default=200, help='Timed requests per operation')
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--export-runs', type=int, default=5)
+        parser.add_argument('--export-formats', nargs='+', choices=[f.value for f in Format], default=['xml', 'json'])
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Results of an earlier run to compare with')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Fail when p50 or p99 of an operation is this much slower than the baseline')
+
+    def handle(self, *args, **options):
+        self.rnd = random.Random(options['seed'])
+        self.user = User.objects.filter(is_superuser=True).order_by('pk').first()
+        if self.user is None:
+            raise CommandError('A superuser is needed, run the demo command')
+        self.client = Client(HTTP_HOST='localhost')
+        self.client.force_login(self.user)
+        self.post_type = ContentType.objects.get_for_model(Post)
+        counters = CommentCounter.objects.filter(content_type=self.post_type).order_by('-count')
+        self.posts = list(counters.values_list('object_id', flat=True)[:100])
+        if not self.posts:
+            raise CommandError('No comments yet, run generate_comments')
+        self.comments = list(Comment.objects.filter(content_type=self.post_type, object_id__in=self.posts)
+                             .order_by('?').values_list('pk', 'object_id')[:1000])
+        self.roots = list(Comment.objects.filter(content_type=self.post_type, object_id__in=self.posts,
+                                                 parent=None).order_by('?').values_list('pk', flat=True)[:1000])
+        self.created = []
+
+        results = {}
+        try:
+            for name in options['operations']:
+                if name == 'export':
+                    for format in options['export_formats']:
+                        results[f'export_{format}'] = self.bench_export(format, options['export_runs'])
+                else:
+                    results[name] = self.bench(getattr(self, f'op_{name}'), options['requests'], options['warmup'])
+                self.stdout.write(self.style.SUCCESS(f'{name} done'))
+        finally:
+            for comment in self.created:
+                self.client.delete(f'/comments/{comment["id"]}/')
+
+        report = {
+            'environment': {
+                'database': connection.vendor,
+                'tree_storage': settings.COMMENTS_TREE_STORAGE,
+                'comments': Comment.objects.count(),
+            },
+            'results': results,
+        }
+        self.print_results(results)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2, sort_keys=True)
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['threshold'])
+
+    def bench(self, operation, requests, warmup):
+        for _ in range(warmup):
+            operation()
+        timings = []
+        started = time.perf_counter()
+        for _ in range(requests):
+            timings.append(operation())
+        return summary(timings, time.perf_counter() - started)
+
+    def timed(self, method, path, **kwargs):
+        started = time.perf_counter()
+        response = getattr(self.client, method)(path, content_type='application/json', **kwargs)
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            raise CommandError(f'{method.upper()} {path}: {response.status_code} {response.content[:200]}')
+        return elapsed, response
+
+    def op_list(self):
+        return self.timed('get', '/comments/', data={'content_type': self.post_type.pk,
+                                                     'object_id': self.rnd.choice(self.posts)})[0]
+
+    def op_retrieve(self):
+        return self.timed('get', f'/comments/{self.rnd.choice(self.comments)[0]}/')[0]
+
+    def op_thread(self):
+        return self.timed('get', f'/comments/{self.rnd.choice(self.roots)}/tree/')[0]
+
+    def op_create(self):
+        parent, post = self.rnd.choice(self.comments)
+        data = {
+            'user': self.user.pk,
+            'text': 'Benchmark comment',
+            'content_type': self.post_type.pk,
+            'object_id': post,
+            'parent': parent,
+        }
+        elapsed, response = self.timed('post', '/comments/', data=json.dumps(data))
+        self.created.append({**data, 'id': response.json()['id']})
+        return elapsed
+
+    def edit_own_comment(self):
+        """
+        Path and body of an update of one of the comments created by the benchmark.
+        """
+        if not self.created:
+            self.op_create()
+        comment = self.rnd.choice(self.created)
+        return f'/comments/{comment["id"]}/', json.dumps({**comment, 'text': f'Edited {time.time()}'})
+
+    def op_update(self):
+        path, data = self.edit_own_comment()
+        return self.timed('put', path, data=data)[0]
+
+    def op_update_fanout(self):
+        """
+        Time from sending an update until it reaches a subscriber of the comment.
+        """
+        path, data = self.edit_own_comment()
+        group = group_name(ContentType.objects.get_for_model(Comment).pk, json.loads(data)['id'])
+        layer = get_channel_layer()
+
+        async def update():
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            try:
+                started = time.perf_counter()
+                self.timed('put', path, data=data)
+                await asyncio.wait_for(layer.receive(channel), timeout=10)
+                return time.perf_counter() - started
+            except asyncio.TimeoutError:
+                raise CommandError(f'No event for {path} within 10s, is the channel layer shared?')
+            finally:
+                await layer.group_discard(group, channel)
+
+        if not hasattr(self, 'loop'):
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(update())
+
+    def bench_export(self, format, runs):
+        post = self.posts[0]
+        user = Comment.objects.filter(content_type=self.post_type, object_id=post).values_list('user', flat=True)[0]
+        timings = []
+        rows = 0
+        for _ in range(runs):
+            history = CommentsHistory.objects.create(user_id=user, content_type=self.post_type, object_id=post,
+                                                     format=format)
+            started = time.perf_counter()
+            history.export()
+            timings.append(time.perf_counter() - started)
+            rows = history.get_exported_comments().count()
+            history.file.delete()
+            history.delete()
+        result = summary(timings, sum(timings))
+        result['rows'] = rows
+        result['rows_per_second'] = round(rows * len(timings) / max(sum(timings), 1e-9))
+        return result
+
+    def print_results(self, results):
+        self.stdout.write(f'{"operation":<16} {"count":>6} {"p50 ms":>9} {"p99 ms":>9} {"mean ms":>9} {"per s":>9}')
+        for name, result in results.items():
+            self.stdout.write(f'{name:<16} {result["count"]:>6} {result["p50_ms"]:>9.2f} {result["p99_ms"]:>9.2f} '
+                              f'{result["mean_ms"]:>9.2f} {result["throughput"]:>9.1f}')
+
+    def compare(self, results, path, threshold):
+        with open(path) as file:
+            baseline = json.load(file)['results']
+        regressions = []
+        for name, result in results.items():
+            for metric in ('p50_ms', 'p99_ms'):
+                if name in baseline and result[metric] > baseline[name][metric] * (1 + threshold):
+                    regressions.append(f'{name} {metric} {baseline[name][metric]} -> {result[metric]}')
+        if regressions:
+            raise CommandError('Regressions over {:.0%}:\n{}'.format(threshold, '\n'.join(regressions)))
+        self.stdout.write(self.style.SUCCESS(f'No regression over {threshold:.0%} against {path}'))
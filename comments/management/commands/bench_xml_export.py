@@ -0,0 +1,45 @@
+import io
+import time
+
+from django.core.management import BaseCommand, CommandError
+
+from comments.export import iterdump_xml, iterdump_xml_sax
+
+
+def _rows(count):
+    for i in range(count):
+        yield {
+            'id': i + 1,
+            'user': i % 100 + 1,
+            'text': f'Comment number {i} with <markup> & "quotes"' if i % 10 else f'Comment number {i}',
+            'created': f'2018-09-10T06:{i // 60 % 60:02}:{i % 60:02}.123456Z',
+            'parent': i if i % 3 else None,
+            'content_type': 8,
+            'object_id': i % 50 + 1,
+            'level': i % 5,
+        }
+
+
+class Command(BaseCommand):
+    help = 'Compare rows/sec of the buffered XML export writer against the SimplerXMLGenerator one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        outputs = {}
+        for name, writer in (('sax', iterdump_xml_sax), ('buffered', iterdump_xml)):
+            best = None
+            for _ in range(options['repeat']):
+                file = io.BytesIO()
+                started = time.perf_counter()
+                writer(file, _rows(options['rows']))
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            outputs[name] = (file.getvalue(), best)
+            self.stdout.write(f'{name:>8}: {options["rows"] / best:12.0f} rows/sec ({best:.3f}s)')
+
+        if outputs['sax'][0] != outputs['buffered'][0]:
+            raise CommandError('Writers produced different output')
+        self.stdout.write(f'Output is identical, speedup x{outputs["sax"][1] / outputs["buffered"][1]:.1f}')
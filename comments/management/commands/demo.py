@@ -1,7 +1,7 @@
 from django.contrib.auth.models import User
 from django.core.management import BaseCommand
 
-from comments.models import Post, Comment
+from comments.models import Post, Comment, CommentCounter
 
 import logging
 
@@ -22,5 +22,6 @@ class Command(BaseCommand):
             for i in range(10):
                 c = Comment.objects.create(user=user, text=f'Comment number {i}', content_object=p)
                 Comment.objects.create(user=user, text=f'Child comment number {i}', content_object=p, parent=c)
+            CommentCounter.objects.rebuild()
             log.info('Demo data created')
 
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from comments.models import CommentsHistory
+
+
+class Command(BaseCommand):
+    help = 'Expire cached history exports by age and total size, fail the ones running for too long'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=settings.COMMENTS_EXPORT_CACHE_MAX_AGE,
+                            help='Seconds')
+        parser.add_argument('--max-size', type=int, default=settings.COMMENTS_EXPORT_CACHE_MAX_SIZE,
+                            help='Bytes')
+        parser.add_argument('--max-running', type=int, default=settings.COMMENTS_EXPORT_MAX_RUNNING_TIME,
+                            help='Seconds')
+
+    def handle(self, *args, **options):
+        failed = CommentsHistory.objects.fail_stale(options['max_running'])
+        self.stdout.write(f'Failed {failed} stale exports')
+        expired = CommentsHistory.objects.evict(options['max_age'], options['max_size'])
+        self.stdout.write(f'Expired {len(expired)} exports')
@@ -0,0 +1,87 @@
+import random
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+
+from comments.bulk import create_comments
+from comments.models import Comment, CommentsHistory, Post
+from comments.tree import tree_storage
+
+
+class Command(BaseCommand):
+    help = ('Show the plans of the canonical comment queries (EXPLAIN ANALYZE on PostgreSQL) '
+            'and fail when one of them does not use its index on PostgreSQL')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Comments to add to a new post first, rolled back afterwards')
+        parser.add_argument('--post', type=int, help='Post to query, by default the one with most comments')
+        parser.add_argument('--verbose', action='store_true', help='Print the plans')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            post = self.seed(options['seed']) if options['seed'] else self.find_post(options['post'])
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE comments_comment')
+            failures = [name for name, expected, plan in self.explain(post)
+                        if not self.report(name, expected, plan, options['verbose'])]
+            transaction.set_rollback(True)
+        # Indexes are tuned for the PostgreSQL planner, other backends only report
+        if failures and connection.vendor == 'postgresql':
+            raise CommandError(f'Expected index not used by: {", ".join(failures)}')
+
+    def find_post(self, pk):
+        post_type = ContentType.objects.get_for_model(Post)
+        if pk is None:
+            top = Comment.objects.filter(content_type=post_type).values('object_id').order_by()
+            top = top.annotate(n=Count('id')).order_by('-n').first()
+            if top is None:
+                raise CommandError('No comments yet, use --seed')
+            pk = top['object_id']
+        return Post.objects.get(pk=pk)
+
+    def seed(self, size):
+        user = User.objects.order_by('pk').first()
+        if user is None:
+            raise CommandError('Create a user first')
+        post = Post.objects.create(text='explain')
+        post_type = ContentType.objects.get_for_model(Post)
+        rnd = random.Random(0)
+        items = []
+        for index in range(size):
+            item = {'user': user.pk, 'text': 'explain', 'content_type': post_type.pk, 'object_id': post.pk}
+            # A tenth of the comments start threads, the rest reply to earlier ones
+            if index and rnd.random() > 0.1:
+                item['parent_index'] = rnd.randrange(index)
+            items.append(item)
+        create_comments(items, {})
+        self.stdout.write(f'Seeded {size} comments on post {post.pk}')
+        return post
+
+    def explain(self, post):
+        post_type = ContentType.objects.get_for_model(Post)
+        storage = tree_storage()
+        comments = Comment.objects.filter(content_type=post_type, object_id=post.pk)
+        first = comments.order_by('id').first()
+        history = CommentsHistory(user_id=first.user_id if first else 0, content_type=post_type, object_id=post.pk,
+                                  date_from=first.created if first else None)
+        thread_index, roots_index = storage.indexes['thread'][0], storage.indexes['roots'][0]
+        queries = [
+            ('thread page', thread_index, comments.order_by(*storage.ordering)[:50]),
+            ('root comments', roots_index, comments.filter(parent=None).order_by(*storage.ordering)[:50]),
+            ('created page', 'comment_object_created_idx', comments.order_by('created', 'id')[:50]),
+            ('history export', 'comment_export_idx', history.get_comments()),
+        ]
+        options = {'analyze': True} if connection.vendor == 'postgresql' else {}
+        for name, expected, queryset in queries:
+            yield name, expected, queryset.explain(**options)
+
+    def report(self, name, expected, plan, verbose):
+        used = expected in plan
+        self.stdout.write(f'{name:<16} {expected:<30} {"ok" if used else "NOT USED"}')
+        if verbose or not used:
+            self.stdout.write(plan + '\n')
+        return used
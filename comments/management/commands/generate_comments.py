@@ -0,0 +1,91 @@
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand
+from django.db.models import Max
+
+from comments.bulk import create_comments
+from comments.models import Post
+
+SHAPES = ('wide', 'deep', 'random', 'mixed')
+
+
+def thread_items(size, shape, rnd, max_level=None):
+    """
+    Parent indexes, within the thread, of a thread of ``size`` comments.
+
+    ``wide`` threads answer the first comment, ``deep`` ones are a single chain
+    and ``random`` ones reply to any earlier comment. Replies that would be
+    nested deeper than ``max_level`` answer the first comment instead.
+    """
+    if shape == 'mixed':
+        shape = rnd.choice(SHAPES[:-1])
+    parents = [None]
+    levels = [0]
+    for index in range(1, size):
+        if shape == 'wide':
+            parent = 0
+        elif shape == 'deep':
+            parent = index - 1
+        else:
+            parent = rnd.randrange(index)
+        if max_level is not None and levels[parent] >= max_level:
+            parent = 0
+        parents.append(parent)
+        levels.append(levels[parent] + 1)
+    return parents
+
+
+class Command(BaseCommand):
+    help = 'Generate users, posts and comment threads of a given shape with bulk inserts, for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--posts', type=int, default=100)
+        parser.add_argument('--comments', type=int, default=100000)
+        parser.add_argument('--thread-size', type=int, default=100, help='Comments per thread')
+        parser.add_argument('--shape', choices=SHAPES, default='mixed')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        started = time.perf_counter()
+
+        first = (User.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        User.objects.bulk_create([User(username=f'load{first + i}', password='!') for i in range(options['users'])],
+                                 batch_size=options['batch_size'])
+        users = list(User.objects.filter(username__startswith='load', pk__gte=first).values_list('pk', flat=True))
+        first = (Post.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        Post.objects.bulk_create([Post(text=f'Load post {first + i}') for i in range(options['posts'])],
+                                 batch_size=options['batch_size'])
+        posts = list(Post.objects.filter(pk__gte=first).values_list('pk', flat=True))
+        post_type = ContentType.objects.get_for_model(Post).pk
+
+        total = 0
+        batch = []
+        while total < options['comments']:
+            size = min(options['thread_size'], options['comments'] - total)
+            post = rnd.choice(posts)
+            offset = len(batch)
+            for index, parent in enumerate(thread_items(size, options['shape'], rnd, settings.COMMENTS_MAX_LEVEL)):
+                batch.append({
+                    'user': rnd.choice(users),
+                    'text': f'Load comment {total + index}',
+                    'content_type': post_type,
+                    'object_id': post,
+                    'parent_index': None if parent is None else offset + parent,
+                })
+            total += size
+            # Threads never span batches, parent indexes stay within one
+            if len(batch) >= options['batch_size'] or total == options['comments']:
+                create_comments(batch, {}, batch_size=options['batch_size'])
+                batch = []
+                self.stdout.write(f'{total} comments', ending='\r')
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Created {len(users)} users, {len(posts)} posts and {total} comments '
+                          f'in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} comments/s)')
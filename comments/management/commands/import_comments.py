@@ -0,0 +1,62 @@
+import json
+import sys
+import time
+
+from django.core.management import BaseCommand, CommandError
+
+from comments.views import BulkCommentSerializer
+
+
+class Command(BaseCommand):
+    help = ('Bulk import comments from JSON lines with user, text, content_type, object_id and parent. '
+            'Rows may also name themselves with "ref" and their parent with "parent_ref".')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='JSON lines file, "-" for stdin')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        file = sys.stdin if options['file'] == '-' else open(options['file'], encoding='utf-8')
+        refs = {}
+        total = 0
+        started = time.perf_counter()
+        with file:
+            batch = []
+            for line_number, line in enumerate(file, 1):
+                if line.strip():
+                    batch.append((line_number, json.loads(line)))
+                if len(batch) == options['batch_size']:
+                    total += self.import_batch(batch, refs)
+                    batch = []
+            if batch:
+                total += self.import_batch(batch, refs)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Imported {total} comments in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f}/s)')
+
+    def import_batch(self, batch, refs):
+        indexes = {}
+        items = []
+        for index, (line_number, row) in enumerate(batch):
+            item = dict(row)
+            ref, parent_ref = item.pop('ref', None), item.pop('parent_ref', None)
+            if parent_ref is not None:
+                if parent_ref in indexes:
+                    item['parent_index'] = indexes[parent_ref]
+                elif parent_ref in refs:
+                    item['parent'] = refs[parent_ref]
+                else:
+                    raise CommandError(f'Line {line_number}: unknown parent_ref {parent_ref!r}')
+            if ref is not None:
+                indexes[ref] = index
+            items.append(item)
+
+        serializer = BulkCommentSerializer(data=items, many=True)
+        if not serializer.is_valid():
+            errors = serializer.errors
+            if isinstance(errors, list):
+                errors = {line_number: error for (line_number, _), error in zip(batch, errors) if error}
+            raise CommandError(f'Invalid comments: {errors}')
+        comments = serializer.save()
+        for ref, index in indexes.items():
+            refs[ref] = comments[index].pk
+        return len(comments)
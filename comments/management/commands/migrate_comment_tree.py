@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+
+from comments.models import Comment
+from comments.tree import STORAGES, rebuild_paths, set_indexes
+
+
+class Command(BaseCommand):
+    help = 'Prepare comment trees and their indexes for a COMMENTS_TREE_STORAGE mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('storage', choices=list(STORAGES))
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['storage'] == 'mptt':
+                # Replies inserted in path mode have no valid lft/rght
+                Comment.objects.rebuild()
+                self.stdout.write('Rebuilt nested sets')
+            else:
+                # Comments inserted in mptt mode have no path
+                self.stdout.write(f'Updated {rebuild_paths(Comment)} paths')
+            set_indexes(connection, Comment._meta.db_table, STORAGES[options['storage']])
+        if settings.COMMENTS_TREE_STORAGE != options['storage']:
+            self.stdout.write(f'Now set COMMENTS_TREE_STORAGE = {options["storage"]!r}')
@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from comments.models import CommentCounter
+
+
+class Command(BaseCommand):
+    help = 'Recompute comment counts of objects and reply counts of comments'
+
+    def handle(self, *args, **options):
+        CommentCounter.objects.rebuild()
+        self.stdout.write(f'Counted comments of {CommentCounter.objects.count()} objects')
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0003_auto_20180910_0603'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commentshistory',
+            name='shards',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='commentshistory',
+            name='shards_done',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:32
+
+import comments.export
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0004_export_shards'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='commentshistory',
+            name='format',
+            field=models.CharField(choices=[('xml', comments.export.Format('xml')), ('json', comments.export.Format('json')), ('jsonl', comments.export.Format('jsonl')), ('csv', comments.export.Format('csv')), ('jsonl.gz', comments.export.Format('jsonl.gz')), ('csv.gz', comments.export.Format('csv.gz')), ('jsonl.zst', comments.export.Format('jsonl.zst')), ('csv.zst', comments.export.Format('csv.zst')), ('columnar', comments.export.Format('columnar'))], max_length=10),
+        ),
+    ]
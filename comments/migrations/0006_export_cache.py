@@ -0,0 +1,25 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:41
+
+import comments.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0005_export_formats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commentshistory',
+            name='params_hash',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=40),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='commentshistory',
+            name='status',
+            field=models.PositiveIntegerField(choices=[(1, comments.models.Status(1)), (2, comments.models.Status(2)), (3, comments.models.Status(3)), (4, comments.models.Status(4)), (5, comments.models.Status(5))], db_index=True, default=comments.models.Status(1)),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0006_export_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commentshistory',
+            name='incremental',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='commentshistory',
+            name='last_comment_id',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='commentshistory',
+            name='previous',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='deltas', to='comments.CommentsHistory'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:48
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def count_comments(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    CommentCounter = apps.get_model('comments', 'CommentCounter')
+    CommentCounter.objects.bulk_create(
+        CommentCounter(content_type_id=row['content_type'], object_id=row['object_id'], count=row['count'])
+        for row in Comment.objects.order_by().values('content_type', 'object_id').annotate(count=Count('id'))
+    )
+    replies = Comment.objects.filter(parent=OuterRef('pk')).order_by().values('parent')
+    Comment.objects.update(reply_count=Coalesce(Subquery(replies.annotate(count=Count('id')).values('count')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('comments', '0007_incremental_export'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='commentcounter',
+            unique_together={('content_type', 'object_id')},
+        ),
+        migrations.RunPython(count_comments, migrations.RunPython.noop),
+    ]
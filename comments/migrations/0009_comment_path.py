@@ -0,0 +1,35 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:51
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Concat, LPad
+
+# comments.tree.path_segment() as of this migration
+PATH_SEGMENT_WIDTH = 10
+
+
+def fill_paths(apps, schema_editor):
+    # Level by level, so that parents have their paths before their replies
+    Comment = apps.get_model('comments', 'Comment')
+    segment = LPad(Cast('id', models.CharField()), PATH_SEGMENT_WIDTH, Value('0'))
+    parent_path = Comment.objects.filter(pk=OuterRef('parent_id')).order_by().values('path')[:1]
+    Comment.objects.filter(level=0).update(path=segment)
+    for level in range(1, (Comment.objects.aggregate(last=Max('level'))['last'] or 0) + 1):
+        Comment.objects.filter(level=level).update(
+            path=Concat(Subquery(parent_path), segment, output_field=models.TextField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0008_comment_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
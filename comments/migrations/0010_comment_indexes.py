@@ -0,0 +1,56 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Thread indexes of the tree storages as of this migration, see
+# comments.tree. Which ones a database keeps depends on its
+# COMMENTS_TREE_STORAGE, so only the migrate_comment_tree command
+# switches them; this creates the ones of the default mptt mode.
+MPTT_INDEXES = {
+    'comment_object_thread_idx': '(content_type_id, object_id, tree_id, lft)',
+    'comment_object_roots_idx': '(content_type_id, object_id, tree_id, lft) WHERE parent_id IS NULL',
+}
+PATH_INDEXES = ['comment_object_path_idx', 'comment_object_path_roots_idx']
+
+
+def create_thread_indexes(apps, schema_editor):
+    table = schema_editor.quote_name(apps.get_model('comments', 'Comment')._meta.db_table)
+    for name, definition in MPTT_INDEXES.items():
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} {definition}')
+
+
+def drop_thread_indexes(apps, schema_editor):
+    # Whichever storage they were switched to since
+    for name in [*MPTT_INDEXES, *PATH_INDEXES]:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0009_comment_path'),
+    ]
+
+    operations = [
+        # Covered by the indexes below, which all start with them
+        migrations.AlterField(
+            model_name='comment',
+            name='content_type',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType'),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='object_id',
+            field=models.PositiveIntegerField(),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['content_type', 'object_id', 'created', 'id'], name='comment_object_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['content_type', 'object_id', 'user', 'created', 'id'], name='comment_export_idx'),
+        ),
+        migrations.RunPython(create_thread_indexes, drop_thread_indexes),
+    ]
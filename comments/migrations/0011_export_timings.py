@@ -0,0 +1,48 @@
+# Generated by Django 2.1.1 on 2026-10-18 10:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0010_comment_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commentshistory',
+            name='duration',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='commentshistory',
+            name='query_time',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='commentshistory',
+            name='queue_time',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='commentshistory',
+            name='rows_exported',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='commentshistory',
+            name='serialize_time',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='commentshistory',
+            name='started',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='commentshistory',
+            name='write_time',
+            field=models.FloatField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.1 on 2026-10-18 10:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0011_export_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commentshistory',
+            name='source_version',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
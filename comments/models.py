@@ -1,34 +1,154 @@
+import datetime
 import enum
+import hashlib
+import json
+import logging
+import math
+import os
+import time
 import uuid
+from functools import lru_cache
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.core.files.uploadedfile import TemporaryUploadedFile
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count, F, Max, Min, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.query_utils import DeferredAttribute
+from django.utils import timezone
 from mptt.fields import TreeForeignKey
 from mptt.models import MPTTModel
 from rest_framework import serializers as rest_serializers
 
-from comments.export import Format, iterdump
+from comments.cache import get_versions, object_version_key
+from comments.events import publish
+from comments.export import Format, iterdump, iterdump_part, join_parts
+from comments.tree import lock_tree_ids, tree_storage
 from core.utils import OverwriteStorage
 
+log = logging.getLogger(__name__)
+
 
 class Comment(MPTTModel):
     user = models.ForeignKey(User, models.CASCADE, related_name='comments')
     text = models.TextField()
     created = models.DateTimeField(auto_now_add=True)
     parent = TreeForeignKey('self', on_delete=models.PROTECT, null=True, blank=True)
-    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
-    object_id = models.PositiveIntegerField(db_index=True)
+    # Indexed together, first in the indexes below and the ones of the tree storage
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, db_index=False)
+    object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey('content_type', 'object_id')
+    reply_count = models.PositiveIntegerField(default=0, editable=False)
+    # Materialized path, maintained in path mode only, see comments.tree.PathStorage
+    path = models.TextField(editable=False, default='')
 
     class MPTTMeta:
         order_insertion_by = ['created']
 
+    class Meta:
+        # Thread indexes depend on COMMENTS_TREE_STORAGE, see comments.tree.set_indexes()
+        indexes = [
+            models.Index(fields=['content_type', 'object_id', 'created', 'id'], name='comment_object_created_idx'),
+            # History exports, see CommentsHistory.get_comments()
+            models.Index(fields=['content_type', 'object_id', 'user', 'created', 'id'], name='comment_export_idx'),
+        ]
+
     def __str__(self):
         return f'{self.content_object} | {self.text}'
 
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            old_parent_id = self._mptt_cached_fields.get('parent', DeferredAttribute)
+            if old_parent_id is not DeferredAttribute and self.parent_id != old_parent_id:
+                # Paths of the subtree and lft/rght in path mode would go stale
+                raise ValueError('Comments can not be moved to another parent.')
+            return super().save(*args, **kwargs)
+        if self.parent_id is not None:
+            return self._insert_node(*args, **kwargs)
+        # MPTT gives new trees MAX(tree_id) + 1
+        with transaction.atomic(savepoint=False):
+            lock_tree_ids()
+            self._insert_node(*args, **kwargs)
+
+    def _insert_node(self, *args, **kwargs):
+        storage = tree_storage()
+        storage.prepare_insert(self)
+        if self.pk is not None:
+            # Reserved by the storage
+            kwargs['force_insert'] = True
+        super().save(*args, **kwargs)
+        storage.finish_insert(self)
+
+    def delete(self, *args, **kwargs):
+        if tree_storage().name == 'path':
+            # Leave lft/rght of the rest of the tree alone
+            return models.Model.delete(self, *args, **kwargs)
+        return super().delete(*args, **kwargs)
+
+    def is_leaf(self):
+        return tree_storage().is_leaf(self)
+
+    def update_counters(self, delta):
+        """
+        Count the comment in (``delta=1``) or out (``delta=-1``) of the
+        comment count of its object and the reply count of its parent.
+        """
+        CommentCounter.objects.add(self.content_type_id, self.object_id, delta)
+        if self.parent_id is not None:
+            Comment.objects.filter(pk=self.parent_id).update(reply_count=F('reply_count') + delta)
+
+
+class CommentCounterQuerySet(models.QuerySet):
+    def add(self, content_type_id, object_id, delta):
+        counter = self.filter(content_type_id=content_type_id, object_id=object_id)
+        if counter.update(count=F('count') + delta):
+            return
+        try:
+            with transaction.atomic():
+                self.create(content_type_id=content_type_id, object_id=object_id, count=max(delta, 0))
+        except IntegrityError:
+            # Created concurrently
+            counter.update(count=F('count') + delta)
+
+    def counts(self, content_type, object_ids):
+        """
+        Comment count of every one of ``object_ids``, zero for objects never commented.
+        """
+        counts = dict.fromkeys(object_ids, 0)
+        counts.update(self.filter(content_type=content_type, object_id__in=object_ids)
+                      .values_list('object_id', 'count'))
+        return counts
+
+    def rebuild(self):
+        """
+        Recompute all comment and reply counts from the comments.
+        """
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(
+                CommentCounter(content_type_id=row['content_type'], object_id=row['object_id'], count=row['count'])
+                for row in Comment.objects.order_by().values('content_type', 'object_id').annotate(count=Count('id'))
+            )
+            replies = Comment.objects.filter(parent=OuterRef('pk')).order_by().values('parent')
+            Comment.objects.update(reply_count=Coalesce(Subquery(replies.annotate(count=Count('id')).values('count')),
+                                                        0))
+
+
+class CommentCounter(models.Model):
+    """
+    Number of comments of an object, maintained on comment creation and deletion.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    objects = CommentCounterQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
 
 class Post(models.Model):
     text = models.TextField()
@@ -41,11 +161,116 @@ class HistoryExportSerializer(rest_serializers.ModelSerializer):
         fields = read_only_fields = ('id', 'user', 'text', 'created', 'parent', 'content_type', 'object_id', 'level')
 
 
+@lru_cache()
+def row_converter(serializer_class):
+    """
+    Compile a function turning a ``values_list(*Meta.fields)`` row into the same
+    dict ``serializer_class(instance).data`` would give, without building a
+    model instance or a serializer per row.
+    """
+    names = serializer_class.Meta.fields
+    fields = serializer_class().fields
+    # Related fields render the raw pk that values_list already returns,
+    # ints and strings render as themselves.
+    identity = (rest_serializers.RelatedField, rest_serializers.IntegerField, rest_serializers.CharField)
+    converters = [None if isinstance(fields[name], identity) else fields[name].to_representation for name in names]
+
+    def convert(row):
+        return dict(zip(names, [
+            value if value is None or converter is None else converter(value)
+            for converter, value in zip(converters, row)
+        ]))
+
+    return convert
+
+
 class Status(enum.IntEnum):
     new = 1
     pending = 2
     success = 3
     error = 4
+    expired = 5
+
+
+class ExportTimings:
+    """
+    Rows of an export run and the time spent fetching and serializing them,
+    the rest of the run goes to writing.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.query = 0.0
+        self.serialize = 0.0
+        self.started = time.perf_counter()
+
+    def write(self):
+        return time.perf_counter() - self.started - self.query - self.serialize
+
+
+class CommentsHistoryQuerySet(models.QuerySet):
+    def lock_params(self, params_hash):
+        """
+        Serialize creation of exports with the same parameters until the end
+        of the current transaction.
+        """
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [int(params_hash[:15], 16)])
+
+    def reusable(self, params_hash):
+        """
+        An export with the same parameters that is still running, or finished
+        with no comments of its object added, edited or deleted since then.
+        Unfinished exports older than ``COMMENTS_EXPORT_MAX_RUNNING_TIME``
+        are taken for lost.
+        """
+        candidates = self.filter(params_hash=params_hash,
+                                 status__in=[Status.new, Status.pending, Status.success]).order_by('-created')
+        deadline = timezone.now() - datetime.timedelta(seconds=settings.COMMENTS_EXPORT_MAX_RUNNING_TIME)
+        for obj in candidates[:1]:
+            if obj.status != Status.success:
+                return obj if obj.created >= deadline else None
+            if obj.file and obj.file.storage.exists(obj.file.name) \
+                    and obj.source_version is not None and obj.source_version == obj.get_source_version() \
+                    and not obj.get_comments().filter(Q(created__gt=obj.created)
+                                                      | Q(id__gt=obj.last_comment_id)).exists():
+                return obj
+        return None
+
+    def last_increment(self, params_hash):
+        """
+        The newest finished export of an incremental chain, to continue from.
+        """
+        return self.filter(params_hash=params_hash, status=Status.success).order_by('-created').first()
+
+    def fail_stale(self, max_running):
+        """
+        Mark exports unfinished after ``max_running`` seconds as failed, their
+        task was lost or their worker died.
+        """
+        deadline = timezone.now() - datetime.timedelta(seconds=max_running)
+        return self.filter(status__in=[Status.new, Status.pending], created__lt=deadline).update(status=Status.error)
+
+    def evict(self, max_age, max_size):
+        """
+        Expire finished exports older than ``max_age`` seconds, then the oldest
+        ones until their files take at most ``max_size`` bytes.
+        """
+        expired = []
+        total_size = 0
+        newest_first = self.filter(status=Status.success).order_by('-created')
+        deadline = timezone.now() - datetime.timedelta(seconds=max_age)
+        for obj in newest_first.iterator():
+            try:
+                total_size += obj.file.size
+            except (ValueError, OSError):
+                pass
+            if obj.created < deadline or total_size > max_size:
+                expired.append(obj)
+        for obj in expired:
+            obj.expire()
+        return expired
 
 
 class CommentsHistory(models.Model):
@@ -59,31 +284,242 @@ class CommentsHistory(models.Model):
     date_from = models.DateTimeField(null=True, blank=True)
     date_to = models.DateTimeField(null=True, blank=True)
     format = models.CharField(max_length=10, choices=[(i.value, i) for i in Format])
+    shards = models.PositiveSmallIntegerField(default=1)
+    shards_done = models.PositiveSmallIntegerField(default=0)
+    params_hash = models.CharField(max_length=40, db_index=True, editable=False)
+    incremental = models.BooleanField(default=False)
+    previous = models.ForeignKey('self', models.SET_NULL, null=True, blank=True, editable=False,
+                                 related_name='deltas')
+    last_comment_id = models.PositiveIntegerField(default=0, editable=False)
+    # Version of the comments of the object when the export was requested, see comments.cache
+    source_version = models.BigIntegerField(null=True, blank=True, editable=False)
+    # Filled in while exporting, times in seconds. Sharded exports add up the
+    # phases of their parts, so these may exceed the duration.
+    started = models.DateTimeField(null=True, blank=True, editable=False)
+    queue_time = models.FloatField(null=True, blank=True, editable=False)
+    duration = models.FloatField(null=True, blank=True, editable=False)
+    rows_exported = models.PositiveIntegerField(default=0, editable=False)
+    query_time = models.FloatField(default=0, editable=False)
+    serialize_time = models.FloatField(default=0, editable=False)
+    write_time = models.FloatField(default=0, editable=False)
+
+    objects = CommentsHistoryQuerySet.as_manager()
+
+    def get_params_hash(self):
+        params = [self.user_id, self.content_type_id, self.object_id, self.date_from, self.date_to,
+                  Format(self.format).value, self.shards]
+        if self.incremental:
+            params.append(True)
+        params = [p.astimezone(datetime.timezone.utc).isoformat() if isinstance(p, datetime.datetime) else p
+                  for p in params]
+        return hashlib.sha1(json.dumps(params).encode('utf-8')).hexdigest()
+
+    def save(self, *args, **kwargs):
+        if not self.params_hash:
+            self.params_hash = self.get_params_hash()
+        if self._state.adding and self.source_version is None:
+            self.source_version = self.get_source_version()
+        super().save(*args, **kwargs)
+
+    def get_source_version(self):
+        """
+        Current version of the comments of the exported object, bumped by every
+        change made through the API, ``None`` when the shared cache is unavailable.
+        """
+        version, = get_versions([object_version_key(self.content_type_id, self.object_id)])
+        return version
 
     def get_comments(self):
-        comments = Comment.objects.filter(user=self.user, content_type=self.content_type, object_id=self.object_id)
+        # Ordered like comment_export_idx
+        comments = Comment.objects.filter(user=self.user, content_type=self.content_type,
+                                          object_id=self.object_id).order_by('created', 'id')
         if self.date_from:
             comments = comments.filter(created__gte=self.date_from)
         if self.date_to:
             comments = comments.filter(created__lte=self.date_to)
+        if self.previous_id is not None:
+            # Ids are assigned before commit, comments below the previous mark
+            # may have been committed after the previous export read its rows
+            since = (self.previous.started or self.previous.created) - datetime.timedelta(
+                seconds=settings.COMMENTS_EXPORT_COMMIT_GRACE)
+            comments = comments.filter(Q(id__gt=self.previous.last_comment_id) | Q(created__gte=since))
         return comments
 
-    def serialized_comments(self):
-        for c in self.get_comments():
-            yield HistoryExportSerializer(c).data
+    def get_exported_comments(self):
+        """
+        Comments of the range up to the high-water mark fixed when the export started.
+        """
+        return self.get_comments().filter(id__lte=self.last_comment_id)
+
+    def _high_water_mark(self, last_id):
+        floor = self.previous.last_comment_id if self.previous_id is not None else 0
+        return max(last_id or 0, floor)
+
+    def serialized_comments(self, comments=None, timings=None):
+        if comments is None:
+            comments = self.get_exported_comments()
+        if timings is None:
+            timings = ExportTimings()
+        convert = row_converter(HistoryExportSerializer)
+        rows = comments.values_list(*HistoryExportSerializer.Meta.fields)
+        rows = rows.iterator(chunk_size=settings.COMMENTS_EXPORT_CHUNK_SIZE)
+        clock = time.perf_counter
+        while True:
+            started = clock()
+            row = next(rows, None)
+            fetched = clock()
+            timings.query += fetched - started
+            if row is None:
+                return
+            row = convert(row)
+            timings.serialize += clock() - fetched
+            timings.rows += 1
+            yield row
+
+    def publish_progress(self, rows_written=None):
+        """
+        Notify subscribers of this export about its progress, never failing the export.
+        """
+        try:
+            publish(self, {
+                'id': str(self.id),
+                'status': self.status,
+                'rows_written': rows_written,
+                'shards': self.shards,
+                'shards_done': self.shards_done,
+                'file': self.file.url if self.file else None,
+            })
+        except Exception:
+            log.warning('Could not publish progress of export %s', self.id, exc_info=True)
+
+    def _track_progress(self, rows):
+        """
+        Pass ``rows`` through, publishing the number written so far at most
+        once per ``COMMENTS_EXPORT_PROGRESS_INTERVAL`` seconds.
+        """
+        interval = settings.COMMENTS_EXPORT_PROGRESS_INTERVAL
+        next_report = time.monotonic() + interval
+        for count, row in enumerate(rows, 1):
+            yield row
+            # Only look at the clock every 1024 rows
+            if not count & 1023 and time.monotonic() >= next_report:
+                self.publish_progress(count)
+                next_report = time.monotonic() + interval
+
+    def _start(self):
+        self.started = timezone.now()
+        self.queue_time = (self.started - self.created).total_seconds()
+
+    def _record_timings(self, timings, **values):
+        """
+        Add the rows and phase times of ``timings`` to the totals of this export.
+        """
+        CommentsHistory.objects.filter(pk=self.pk).update(
+            rows_exported=F('rows_exported') + timings.rows,
+            query_time=F('query_time') + timings.query,
+            serialize_time=F('serialize_time') + timings.serialize,
+            write_time=F('write_time') + timings.write(),
+            **values,
+        )
+        self.refresh_from_db(fields=['rows_exported', 'query_time', 'serialize_time', 'write_time', *values])
+
+    def _write_file(self, write, timings):
+        name = self.file.field.generate_filename(self, f'{self.id}.{self.format}')
+        with self.file.storage.open_atomic(name) as file:
+            write(file)
+        self._record_timings(timings)
+        self.file.name = name
+        self.status = Status.success
+        self.duration = (timezone.now() - self.started).total_seconds()
+        self.save(update_fields=['file', 'status', 'duration'])
+        log.info('Exported %s: %d rows in %.1fs (%.0f rows/s), query %.1fs, serialize %.1fs, write %.1fs',
+                 self.id, self.rows_exported, self.duration, self.rows_exported / max(self.duration, 1e-9),
+                 self.query_time, self.serialize_time, self.write_time)
+        self.publish_progress()
 
     def export(self):
         self.status = Status.pending
+        self._start()
+        self.last_comment_id = self._high_water_mark(self.get_comments().aggregate(last=Max('id'))['last'])
         self.save()
+        timings = ExportTimings()
         try:
-            with TemporaryUploadedFile(f'{self.id}.{self.format}',
-                                       content_type=f'application/{self.format}',
-                                       size=0, charset='utf-8') as tmp:
-                iterdump(self.format, tmp, self.serialized_comments())
-                self.file = tmp
-                self.status = Status.success
-                self.save()
+            self._write_file(lambda file: iterdump(self.format, file, self._track_progress(
+                self.serialized_comments(timings=timings))), timings)
         except Exception:
             self.status = Status.error
-            self.save()
+            self.save(update_fields=['status'])
+            self.publish_progress()
             raise
+
+    def split(self):
+        """
+        Split the exported comments into at most ``shards`` contiguous id ranges
+        and start a sharded export over them.
+        """
+        bounds = self.get_comments().aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            ranges = [(0, 0)]
+        else:
+            step = math.ceil((bounds['last'] - bounds['first'] + 1) / self.shards)
+            ranges = [(first, min(first + step - 1, bounds['last']))
+                      for first in range(bounds['first'], bounds['last'] + 1, step)]
+        self.shards, self.shards_done, self.status = len(ranges), 0, Status.pending
+        self._start()
+        self.last_comment_id = self._high_water_mark(bounds['last'])
+        self.save(update_fields=['shards', 'shards_done', 'status', 'started', 'queue_time', 'last_comment_id'])
+        return ranges
+
+    def part_path(self, number):
+        return os.path.join(settings.FILE_UPLOAD_TEMP_DIR, f'{self.id}.{number}.part')
+
+    def export_part(self, number, first_id, last_id):
+        comments = self.get_exported_comments().filter(id__gte=first_id, id__lte=last_id)
+        timings = ExportTimings()
+        with open(self.part_path(number), 'wb') as part:
+            iterdump_part(self.format, part, self.serialized_comments(comments, timings))
+        self._record_timings(timings, shards_done=F('shards_done') + 1)
+        self.publish_progress()
+
+    def join_parts(self):
+        def write(file):
+            parts = [open(self.part_path(number), 'rb') for number in range(self.shards)]
+            try:
+                join_parts(self.format, file, parts)
+            finally:
+                for part in parts:
+                    part.close()
+
+        try:
+            self._write_file(write, ExportTimings())
+        except Exception:
+            self.status = Status.error
+            self.save(update_fields=['status'])
+            self.publish_progress()
+            raise
+        finally:
+            self.remove_parts()
+
+    def get_chain(self):
+        """
+        Exports of an incremental chain from the full one up to this one.
+        """
+        links = {obj.pk: obj for obj in CommentsHistory.objects.filter(params_hash=self.params_hash)}
+        links[self.pk] = self
+        chain = [self]
+        while chain[-1].previous_id is not None and chain[-1].previous_id in links:
+            chain.append(links[chain[-1].previous_id])
+        return chain[::-1]
+
+    def expire(self):
+        self.file.delete(save=False)
+        self.status = Status.expired
+        self.save(update_fields=['file', 'status'])
+        self.publish_progress()
+
+    def remove_parts(self):
+        for number in range(self.shards):
+            try:
+                os.remove(self.part_path(number))
+            except FileNotFoundError:
+                pass
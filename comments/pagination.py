@@ -0,0 +1,157 @@
+import base64
+import binascii
+import datetime
+import json
+from collections import OrderedDict
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from comments.tree import tree_storage
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (seek) pagination over a unique composite ordering.
+
+    Pages are addressed by an opaque cursor holding the ordering key of the
+    last (or first) row seen, so any page costs one index range scan and no
+    ``COUNT(*)`` is ever issued.
+    """
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    limit_query_param = 'limit'
+    orderings = {
+        'thread': None,  # the ordering of the tree storage
+        'created': ('created', 'id'),
+    }
+    default_ordering = 'thread'
+    default_limit = api_settings.PAGE_SIZE
+    max_limit = 1000
+    invalid_cursor_message = 'Invalid cursor'
+    display_page_controls = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.model = queryset.model
+        self.limit = self.get_limit(request)
+        self.ordering_name, position, reverse = self.decode_cursor(request)
+        fields = self.get_ordering_fields(self.ordering_name)
+
+        queryset = queryset.order_by(*(f'-{f}' if reverse else f for f in fields))
+        if position is not None:
+            queryset = queryset.filter(self.seek_filter(fields, position, reverse))
+
+        # Fetch one extra row to find out whether there is a following page.
+        results = list(queryset[:self.limit + 1])
+        has_more = len(results) > self.limit
+        results = results[:self.limit]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+
+        self.page = results
+        return results
+
+    def get_ordering_fields(self, name):
+        return self.orderings[name] or tree_storage().ordering
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(request.query_params[self.limit_query_param], strict=True, cutoff=self.max_limit)
+        except (KeyError, ValueError):
+            return self.default_limit
+
+    @staticmethod
+    def seek_filter(fields, position, reverse=False):
+        """
+        Row-value comparison ``(f1, f2, ...) > (v1, v2, ...)`` spelled out as
+        a disjunction, with a leading bound on the first column so the planner
+        can start an index range scan from the cursor.
+        """
+        lookup = 'lt' if reverse else 'gt'
+        clauses = []
+        for i, field in enumerate(fields):
+            clause = dict(zip(fields[:i], position[:i]))
+            clause[f'{field}__{lookup}'] = position[i]
+            clauses.append(Q(**clause))
+        bound = Q(**{f'{fields[0]}__{lookup}e': position[0]})
+        return bound & reduce(or_, clauses)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            ordering = request.query_params.get(self.ordering_query_param, self.default_ordering)
+            if ordering not in self.orderings:
+                raise NotFound(f'Invalid ordering, expected one of: {", ".join(self.orderings)}')
+            return ordering, None, False
+
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            ordering, reverse = data['o'], bool(data['r'])
+            fields = self.get_ordering_fields(ordering)
+            if len(data['p']) != len(fields):
+                raise ValueError(data['p'])
+            position = tuple(self.model._meta.get_field(f).to_python(v) for f, v in zip(fields, data['p']))
+        except (TypeError, ValueError, KeyError, UnicodeError, binascii.Error, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return ordering, position, reverse
+
+    def encode_cursor(self, obj, reverse):
+        fields = self.get_ordering_fields(self.ordering_name)
+        position = [getattr(obj, f) for f in fields]
+        data = {
+            'o': self.ordering_name,
+            'p': [v.isoformat() if isinstance(v, datetime.datetime) else v for v in position],
+            'r': int(reverse),
+        }
+        encoded = base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode('utf-8')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class CommentPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination by default; switches to :class:`KeysetPagination`
+    when a ``cursor`` is passed or ``pagination=cursor`` is requested.
+    """
+    mode_query_param = 'pagination'
+    keyset_class = KeysetPagination
+    keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if (request.query_params.get(self.mode_query_param) == 'cursor'
+                or self.keyset_class.cursor_query_param in request.query_params):
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
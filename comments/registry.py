@@ -0,0 +1,106 @@
+import threading
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+
+from comments.validation import known_objects, object_exists
+
+
+class ObjectResolver:
+    """
+    Existence checks for the objects of one content type.
+    """
+
+    def __init__(self, content_type):
+        self.content_type = content_type
+        self.model = content_type.model_class()
+
+    def to_pk(self, value):
+        """
+        ``value`` as a primary key of the model, ``ValidationError`` if it can not be one.
+        """
+        pk = self.model._meta.pk.to_python(value)
+        if pk is None:
+            raise ValidationError('This field may not be null.')
+        return pk
+
+    def exists(self, value):
+        try:
+            return object_exists(self.model, self.to_pk(value))
+        except ValidationError:
+            return False
+
+    def existing(self, pks):
+        """
+        The existing ones of ``pks``, converted with ``to_pk``. Objects not
+        known to exist are looked up with one ``IN`` query.
+        """
+        label = self.model._meta.label_lower
+        found = {pk for pk in pks if known_objects.get((label, pk))}
+        missing = [pk for pk in pks if pk not in found]
+        if missing:
+            for pk in self.model._default_manager.filter(pk__in=missing).values_list('pk', flat=True):
+                known_objects.set((label, pk), True)
+                found.add(pk)
+        return found
+
+
+class ContentTypeRegistry:
+    """
+    Content types of the models named by ``labels``, resolved once through
+    Django's ``ContentType`` cache, so that validating them takes no query.
+
+    The ids are read on first use rather than at import, when the database
+    may not be migrated yet, and forgotten after each migration.
+    """
+
+    def __init__(self, *labels):
+        self.labels = labels
+        self._resolvers = None
+        self.lock = threading.Lock()
+
+    @property
+    def resolvers(self):
+        resolvers = self._resolvers
+        if resolvers is None:
+            with self.lock:
+                if self._resolvers is None:
+                    types = ContentType.objects.get_for_models(*[apps.get_model(label) for label in self.labels])
+                    self._resolvers = {ct.pk: ObjectResolver(ct) for ct in types.values()}
+                resolvers = self._resolvers
+        return resolvers
+
+    def __deepcopy__(self, memo):
+        # Shared, serializer fields holding it are copied per serializer
+        return self
+
+    def clear(self):
+        self._resolvers = None
+
+    def ids(self):
+        return list(self.resolvers)
+
+    def queryset(self):
+        return ContentType.objects.filter(pk__in=self.ids())
+
+    def resolver(self, content_type_id):
+        """
+        Resolver of a registered content type, ``None`` for unknown ids.
+        """
+        return self.resolvers.get(content_type_id)
+
+    def get(self, content_type_id):
+        resolver = self.resolver(content_type_id)
+        return resolver.content_type if resolver is not None else None
+
+
+# Models comments can be attached to
+commentable = ContentTypeRegistry('comments.Post', 'auth.User')
+# Objects WebSocket clients can follow
+subscribable = ContentTypeRegistry('comments.Post', 'auth.User', 'comments.Comment', 'comments.CommentsHistory')
+
+
+def clear_registries(**kwargs):
+    commentable.clear()
+    subscribable.clear()
@@ -1,8 +1,74 @@
-from comments.models import CommentsHistory
-from core import celery_app
+from celery import chord
+from django.conf import settings
+from django.db.models import Count, Sum
+
+from comments.models import CommentsHistory, Status
+from core import celery_app, metrics
 
 
 @celery_app.task
 def export_comments_history(obj_id):
     obj = CommentsHistory.objects.get(pk=obj_id)
-    obj.export()
+    if obj.shards > 1:
+        ranges = obj.split()
+        join = join_comments_history_parts.s(obj_id)
+        join.link_error(fail_comments_history.si(obj_id))
+        chord([export_comments_history_part.s(obj_id, number, first_id, last_id)
+               for number, (first_id, last_id) in enumerate(ranges)])(join)
+    else:
+        obj.export()
+        evict_comments_history.delay()
+
+
+@celery_app.task
+def export_comments_history_part(obj_id, number, first_id, last_id):
+    obj = CommentsHistory.objects.get(pk=obj_id)
+    obj.export_part(number, first_id, last_id)
+
+
+@celery_app.task
+def join_comments_history_parts(_, obj_id):
+    obj = CommentsHistory.objects.get(pk=obj_id)
+    obj.join_parts()
+    evict_comments_history.delay()
+
+
+@celery_app.task
+def fail_comments_history(obj_id):
+    obj = CommentsHistory.objects.get(pk=obj_id)
+    obj.status = Status.error
+    obj.save(update_fields=['status'])
+    obj.publish_progress()
+    obj.remove_parts()
+
+
+@celery_app.task
+def evict_comments_history():
+    CommentsHistory.objects.fail_stale(settings.COMMENTS_EXPORT_MAX_RUNNING_TIME)
+    CommentsHistory.objects.evict(settings.COMMENTS_EXPORT_CACHE_MAX_AGE, settings.COMMENTS_EXPORT_CACHE_MAX_SIZE)
+
+
+@metrics.collector
+def export_metrics():
+    """
+    Export queue and throughput, from the database since exports run in the workers.
+    """
+    exports = metrics.Gauge('comments_exports', 'Exports by status, new ones wait for a worker')
+    for row in CommentsHistory.objects.order_by().values('status').annotate(count=Count('id')):
+        exports.set(row['count'], status=Status(row['status']).name)
+
+    totals = CommentsHistory.objects.filter(duration__isnull=False).aggregate(
+        count=Count('id'), rows=Sum('rows_exported'), queue=Sum('queue_time'), duration=Sum('duration'),
+        query=Sum('query_time'), serialize=Sum('serialize_time'), write=Sum('write_time'))
+    finished = metrics.Counter('comments_exports_finished_total', 'Finished exports')
+    finished.inc(totals['count'])
+    rows = metrics.Counter('comments_export_rows_total', 'Rows written by finished exports')
+    rows.inc(totals['rows'] or 0)
+    queue = metrics.Counter('comments_export_queue_seconds_total', 'Time finished exports waited for a worker')
+    queue.inc(totals['queue'] or 0)
+    duration = metrics.Counter('comments_export_duration_seconds_total', 'Time finished exports took once started')
+    duration.inc(totals['duration'] or 0)
+    phases = metrics.Counter('comments_export_phase_seconds_total', 'Time finished exports spent per phase')
+    for phase in ('query', 'serialize', 'write'):
+        phases.inc(totals[phase] or 0, phase=phase)
+    return [exports, finished, rows, queue, duration, phases]
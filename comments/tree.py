@@ -0,0 +1,200 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import CharField, Max, OuterRef, Subquery, TextField, Value
+from django.db.models.functions import Cast, Concat, LPad
+
+# Digits of the largest id
+PATH_SEGMENT_WIDTH = 10
+# Advisory lock key taken while allocating tree ids
+TREE_ID_LOCK = 0x636f6d6d656e7473
+
+
+def path_segment(pk):
+    """
+    Zero padded ``pk``, so that paths sort like their ids.
+    """
+    return str(pk).rjust(PATH_SEGMENT_WIDTH, '0')
+
+
+def path_segment_expression(field='id'):
+    """
+    ``path_segment`` of the ``field`` column, computed by the database.
+    """
+    return LPad(Cast(field, CharField()), PATH_SEGMENT_WIDTH, Value('0'))
+
+
+def next_path(path):
+    """
+    The smallest path of the same length sorting after ``path`` and all its descendants.
+    """
+    return str(int(path) + 1).rjust(len(path), '0')
+
+
+def reserve_id(model):
+    """
+    Next id of ``model`` taken from its sequence, PostgreSQL only.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s))', [model._meta.db_table, model._meta.pk.column])
+        return cursor.fetchone()[0]
+
+
+class MPTTStorage:
+    """
+    Nested sets maintained by django-mptt, reads are ranges over ``tree_id, lft``
+    but inserts shift ``lft``/``rght`` of the rest of the tree.
+    """
+    name = 'mptt'
+    ordering = ('tree_id', 'lft')
+    # Threads and top level comments (is_root filter) of an object, in ``ordering``
+    indexes = {
+        'thread': ('comment_object_thread_idx', '(content_type_id, object_id, tree_id, lft)'),
+        'roots': ('comment_object_roots_idx', '(content_type_id, object_id, tree_id, lft) WHERE parent_id IS NULL'),
+    }
+
+    def subtree(self, node):
+        return node.get_descendants(include_self=True)
+
+    def contains(self, ancestor, node):
+        return node.tree_id == ancestor.tree_id and node.rght < ancestor.rght
+
+    def is_leaf(self, node):
+        return node.is_leaf_node()
+
+    def prepare_insert(self, node):
+        pass
+
+    def finish_insert(self, node):
+        pass
+
+
+class PathStorage(MPTTStorage):
+    """
+    Materialized paths: every comment stores the ``path_segment`` of its
+    ancestors and its own, a reply is inserted with its parent's values only.
+    MPTT keeps ``tree_id`` and ``level`` but ``lft``/``rght`` are not maintained.
+    Paths are only written in this mode, ``migrate_comment_tree path`` rebuilds them.
+    """
+    name = 'path'
+    ordering = ('path',)
+    indexes = {
+        'thread': ('comment_object_path_idx', '(content_type_id, object_id, path)'),
+        'roots': ('comment_object_path_roots_idx', '(content_type_id, object_id, path) WHERE parent_id IS NULL'),
+    }
+
+    def subtree(self, node):
+        return type(node)._default_manager.filter(
+            content_type_id=node.content_type_id, object_id=node.object_id,
+            path__gte=node.path, path__lt=next_path(node.path),
+        ).order_by('path')
+
+    def contains(self, ancestor, node):
+        return node.path.startswith(ancestor.path)
+
+    def is_leaf(self, node):
+        return node.reply_count == 0
+
+    def prepare_insert(self, node):
+        parent = node.parent
+        if parent is not None:
+            # Preset tree fields make MPTT insert without making room in the tree
+            node.tree_id, node.level, node.lft, node.rght = parent.tree_id, parent.level + 1, 1, 2
+        if connection.vendor == 'postgresql':
+            # Insert the row with its path rather than writing it twice
+            node.pk = reserve_id(type(node))
+            node.path = self.path(node)
+
+    def finish_insert(self, node):
+        if not node.path:
+            node.path = self.path(node)
+            type(node)._default_manager.filter(pk=node.pk).update(path=node.path)
+
+    def path(self, node):
+        return (node.parent.path if node.parent_id is not None else '') + path_segment(node.pk)
+
+
+STORAGES = {storage.name: storage for storage in (MPTTStorage(), PathStorage())}
+
+
+def tree_storage():
+    return STORAGES[settings.COMMENTS_TREE_STORAGE]
+
+
+def lock_tree_ids():
+    """
+    Serialize allocation of new tree ids (``MAX(tree_id) + 1``) until the end
+    of the current transaction.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [TREE_ID_LOCK])
+
+
+def set_indexes(connection, table, storage):
+    """
+    Create the ``indexes`` of ``storage`` on ``table`` and drop those of the
+    other storages, only the configured storage's are worth their writes.
+    """
+    wanted = dict(storage.indexes.values())
+    with connection.cursor() as cursor:
+        for other in STORAGES.values():
+            for name, _ in other.indexes.values():
+                if name not in wanted:
+                    cursor.execute(f'DROP INDEX IF EXISTS {name}')
+        for name, definition in wanted.items():
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {connection.ops.quote_name(table)} {definition}')
+
+
+def build_tree(nodes, to_representation, max_children=None, max_level=None, storage=None):
+    """
+    Nest ``nodes`` given in thread order (``storage.ordering``) in a single pass.
+
+    Every node is turned into a dict by ``to_representation`` and gets a
+    ``children`` list. At most ``max_children`` children are kept per node,
+    the subtrees of the rest are skipped. Nodes cut by ``max_children`` or
+    lying at ``max_level`` while having descendants are flagged ``truncated``.
+    Nodes whose parent is not in ``nodes`` become roots of the returned list.
+    """
+    storage = storage or tree_storage()
+    roots = []
+    stack = []  # open ancestors of the current node as (node, item) pairs
+    pruned = None
+    for node in nodes:
+        if pruned is not None and storage.contains(pruned, node):
+            continue
+        pruned = None
+
+        while stack and not storage.contains(stack[-1][0], node):
+            stack.pop()
+
+        if stack:
+            parent_item = stack[-1][1]
+            if max_children is not None and len(parent_item['children']) >= max_children:
+                parent_item['truncated'] = True
+                pruned = node
+                continue
+            siblings = parent_item['children']
+        else:
+            siblings = roots
+
+        item = to_representation(node)
+        item['children'] = []
+        item['truncated'] = max_level is not None and node.level >= max_level and not storage.is_leaf(node)
+        siblings.append(item)
+        stack.append((node, item))
+    return roots
+
+
+def rebuild_paths(model):
+    """
+    Recompute the materialized paths of all ``model`` rows from their
+    parents, with one ``UPDATE`` per level.
+    """
+    manager = model._default_manager
+    segment = path_segment_expression()
+    parent_path = manager.filter(pk=OuterRef('parent_id')).order_by().values('path')[:1]
+    updated = manager.filter(level=0).update(path=segment)
+    for level in range(1, (manager.aggregate(last=Max('level'))['last'] or 0) + 1):
+        updated += manager.filter(level=level).update(
+            path=Concat(Subquery(parent_path), segment, output_field=TextField()))
+    return updated
@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from rest_framework import serializers
+
+from core.utils import TTLCache
+
+# (model label, pk) of objects recently seen in the database
+known_objects = TTLCache(settings.COMMENTS_KNOWN_OBJECTS_CACHE_SIZE, settings.COMMENTS_KNOWN_OBJECTS_CACHE_TTL)
+
+
+def object_exists(model, pk):
+    """
+    Whether ``model`` has a row ``pk``, asked with ``EXISTS`` and remembered
+    for ``COMMENTS_KNOWN_OBJECTS_CACHE_TTL`` seconds when it does.
+    """
+    key = (model._meta.label_lower, pk)
+    if known_objects.get(key):
+        return True
+    exists = model._default_manager.filter(pk=pk).exists()
+    if exists:
+        known_objects.set(key, True)
+    return exists
+
+
+@receiver(post_delete)
+def forget_deleted(sender, instance, **kwargs):
+    known_objects.delete((sender._meta.label_lower, instance.pk))
+
+
+class ExistingObjectField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key related field checking existence only, it gives an instance
+    holding nothing but the pk.
+    """
+
+    def to_internal_value(self, data):
+        model = self.get_queryset().model
+        try:
+            pk = model._meta.pk.to_python(data)
+        except ValidationError:
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk is None or not object_exists(model, pk):
+            self.fail('does_not_exist', pk_value=data)
+        return model(pk=pk)
+
+
+class ContentTypeField(serializers.PrimaryKeyRelatedField):
+    """
+    Content type of one of the models of ``registry``, resolved without queries.
+    """
+
+    def __init__(self, registry, **kwargs):
+        self.registry = registry
+        if not kwargs.get('read_only'):
+            kwargs.setdefault('queryset', ContentType.objects.all())
+        super().__init__(**kwargs)
+
+    def get_queryset(self):
+        # Choices of the browsable API
+        return self.registry.queryset()
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            content_type = self.registry.get(int(data))
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if content_type is None:
+            self.fail('does_not_exist', pk_value=data)
+        return content_type
@@ -1,17 +1,31 @@
+import copy
+
 import django_filters
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-from rest_framework import mixins, routers, serializers, viewsets
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
+from rest_framework import mixins, routers, serializers, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
-from comments.models import Comment, CommentsHistory, Post
+from comments.bulk import check_comments, create_comments
+from comments.cache import CachedResponseMixin, invalidate_comments
+from comments.events import COMMENT_CREATED, COMMENT_DELETED, publish_comment, publish_on_commit
+from comments.export import content_type, is_available, iterdump_chunks
+from comments.models import Comment, CommentCounter, CommentsHistory, Post, Status
+from comments.pagination import CommentPagination
+from comments.registry import commentable
 from comments.tasks import export_comments_history
+from comments.tree import build_tree, tree_storage
+from comments.validation import ContentTypeField, ExistingObjectField
+from core.instrumentation import TimedSerializerMixin
 
 router = routers.DefaultRouter()
-channel_layer = get_channel_layer()
 
 _HTML_CUTOFF_TEXT = 'Limited records number are shown. You can use this form only for demo purpose.'
 
@@ -19,17 +33,10 @@ _HTML_CUTOFF_TEXT = 'Limited records number are shown. You can use this form onl
 class UpdateModelMixin(mixins.UpdateModelMixin):
     def perform_update(self, serializer):
         super().perform_update(serializer)
-        instance = serializer.instance
-        ct = ContentType.objects.get_for_model(instance.__class__)
-        async_to_sync(channel_layer.group_send)(f"{ct.pk}.{instance.pk}", {
-            "type": "object.updated",
-            "content_type": ct.pk,
-            "object_id": instance.pk,
-            "data": serializer.data
-        })
+        publish_on_commit(serializer.instance, serializer.data)
 
 
-class ContentTypeSerializer(serializers.ModelSerializer):
+class ContentTypeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = ContentType
         fields = ('id', 'url', 'app_label', 'model')
@@ -42,12 +49,15 @@ class ContentTypeFilter(django_filters.FilterSet):
 
 
 class ContentTypeViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = ContentType.objects.filter(model__in=[Post._meta.model_name, User._meta.model_name])
+    queryset = ContentType.objects.all()
     serializer_class = ContentTypeSerializer
     filter_class = ContentTypeFilter
 
+    def get_queryset(self):
+        return commentable.queryset()
+
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'url', 'username',)
@@ -58,41 +68,84 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = UserSerializer
 
 
-class CommentSerializer(serializers.ModelSerializer):
-    content_type = serializers.PrimaryKeyRelatedField(queryset=ContentTypeViewSet.queryset)
-    parent = serializers.PrimaryKeyRelatedField(allow_null=True, queryset=Comment.objects.all(),
+class CommentSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    content_type = ContentTypeField(commentable)
+    # Only what validation and the tree insert need
+    parent = serializers.PrimaryKeyRelatedField(allow_null=True, queryset=Comment.objects.only(
+        'content_type_id', 'object_id', 'parent_id', 'tree_id', 'lft', 'rght', 'level', 'path'),
                                                 html_cutoff_text=_HTML_CUTOFF_TEXT,
                                                 html_cutoff=10)
-    user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), html_cutoff_text=_HTML_CUTOFF_TEXT,
-                                              html_cutoff=10)
+    user = ExistingObjectField(queryset=User.objects.all(), html_cutoff_text=_HTML_CUTOFF_TEXT, html_cutoff=10)
 
     class Meta:
         model = Comment
-        fields = ('id', 'url', 'user', 'text', 'created', 'parent', 'content_type', 'object_id', 'level')
-        read_only_fields = ('created', 'level')
+        fields = ('id', 'url', 'user', 'text', 'created', 'parent', 'content_type', 'object_id', 'level',
+                  'reply_count')
+        read_only_fields = ('created', 'level', 'reply_count')
 
     def validate(self, data):
         """
         Check that the start is before the stop.
         """
+        if self.instance is not None:
+            # Comments stay where they were posted, moving one would have to
+            # move its subtree and the reply and comment counts along
+            current = {'parent': self.instance.parent_id, 'content_type': self.instance.content_type_id,
+                       'object_id': self.instance.object_id}
+            for field, value in current.items():
+                if field in data and getattr(data[field], 'pk', data[field]) != value:
+                    raise serializers.ValidationError({field: 'Can not be changed.'})
+            return data
+        if data['parent'] and data['parent'].level >= settings.COMMENTS_MAX_LEVEL:
+            raise serializers.ValidationError({'parent': f'Replies can be nested at most '
+                                                         f'{settings.COMMENTS_MAX_LEVEL} levels deep.'})
         if data['parent']:
-            if data['content_type'] != data['parent'].content_type:
+            if data['content_type'].pk != data['parent'].content_type_id:
                 raise serializers.ValidationError({'content_type': 'Must be same with parent comment\'s content_type'})
             if data['object_id'] != data['parent'].object_id:
                 raise serializers.ValidationError({'object_id': 'Must be same with parent comment\'s object_id'})
-        model_cls: models.Model = data['content_type'].model_class()
+        resolver = commentable.resolver(data['content_type'].pk)
 
-        try:
-            model_cls.objects.get(pk=data['object_id'])
-        except model_cls.DoesNotExist as e:
-            raise serializers.ValidationError({'object_id': f"Invalid pk \"{data['object_id']}\" - {e}"})
+        if not resolver.exists(data['object_id']):
+            raise serializers.ValidationError({'object_id': f"Invalid pk \"{data['object_id']}\" - "
+                                                            f"{resolver.model.__name__} matching query does not exist."})
 
         return data
 
 
+class BulkCommentListSerializer(serializers.ListSerializer):
+    def to_internal_value(self, data):
+        if isinstance(data, list) and len(data) > settings.COMMENTS_BULK_MAX_BATCH:
+            raise serializers.ValidationError(f'At most {settings.COMMENTS_BULK_MAX_BATCH} comments per batch.')
+        items = super().to_internal_value(data)
+        # Errors by item, like the ones of the item fields
+        self.parents, errors = check_comments(items, commentable)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
+    def create(self, validated_data):
+        return create_comments(validated_data, self.parents)
+
+
+class BulkCommentSerializer(serializers.Serializer):
+    """
+    A comment of a batch, related objects are checked for the whole batch at once.
+    """
+    user = serializers.IntegerField()
+    text = serializers.CharField()
+    content_type = serializers.IntegerField()
+    object_id = serializers.IntegerField(min_value=0)
+    parent = serializers.IntegerField(allow_null=True, required=False)
+    parent_index = serializers.IntegerField(min_value=0, allow_null=True, required=False)
+
+    class Meta:
+        list_serializer_class = BulkCommentListSerializer
+
+
 class CommentFilter(django_filters.FilterSet):
     is_root = django_filters.BooleanFilter(field_name='parent', lookup_expr='isnull', label='Is root')
-    content_type = django_filters.ModelChoiceFilter(queryset=ContentTypeViewSet.queryset)
+    content_type = django_filters.ModelChoiceFilter(queryset=lambda request: commentable.queryset())
     parent = django_filters.NumberFilter()
 
     class Meta:
@@ -100,43 +153,167 @@ class CommentFilter(django_filters.FilterSet):
         fields = ('content_type', 'parent', 'object_id', 'user', 'is_root')
 
 
-class CommentViewSet(UpdateModelMixin, viewsets.ModelViewSet):
+class TreeParamsSerializer(serializers.Serializer):
+    max_depth = serializers.IntegerField(min_value=0, required=False)
+    max_children = serializers.IntegerField(min_value=0, required=False)
+
+
+class ObjectTreeParamsSerializer(TreeParamsSerializer):
+    content_type = ContentTypeField(commentable)
+    object_id = serializers.IntegerField()
+
+
+class CountsParamsSerializer(serializers.Serializer):
+    max_ids = 1000
+
+    content_type = ContentTypeField(commentable)
+    object_id = serializers.ListField(child=serializers.IntegerField(min_value=0), allow_empty=False)
+
+    def validate_object_id(self, value):
+        if len(value) > self.max_ids:
+            raise serializers.ValidationError(f'At most {self.max_ids} object ids per request.')
+        return value
+
+
+class CommentViewSet(CachedResponseMixin, UpdateModelMixin, viewsets.ModelViewSet):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     filterset_class = CommentFilter
+    pagination_class = CommentPagination
+
+    def get_queryset(self):
+        # Filtered by object, served in order by the thread index of the storage
+        return super().get_queryset().order_by(*tree_storage().ordering)
+
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            super().perform_create(serializer)
+            serializer.instance.update_counters(1)
+            invalidate_comments([serializer.instance])
+        publish_comment(serializer.instance, serializer.data, COMMENT_CREATED)
 
     def perform_destroy(self, instance):
-        if instance.is_leaf_node():
-            return super().perform_destroy(instance)
+        if instance.is_leaf():
+            data = self.get_serializer(instance).data
+            with transaction.atomic():
+                invalidate_comments([instance])
+                super().perform_destroy(instance)
+                instance.update_counters(-1)
+            return publish_comment(instance, data, COMMENT_DELETED)
         raise serializers.ValidationError('Can not delete comment, comment has children.')
 
     def perform_update(self, serializer):
-        if serializer.instance and serializer.instance.is_leaf_node():
-            return super().perform_update(serializer)
+        if serializer.instance and serializer.instance.is_leaf():
+            # Where the comment was shown before and after the update
+            before = copy.copy(serializer.instance)
+            with transaction.atomic():
+                super().perform_update(serializer)
+                invalidate_comments([before, serializer.instance])
+            return
         raise serializers.ValidationError('Can not update comment, comment has children.')
 
+    def get_tree(self, nodes, params, max_level=None):
+        if max_level is not None:
+            nodes = nodes.filter(level__lte=max_level)
+        serializer = self.get_serializer()
+        return build_tree(nodes, serializer.to_representation,
+                          max_children=params.get('max_children'), max_level=max_level)
+
+    @action(detail=True)
+    def tree(self, request, pk=None):
+        """
+        Whole subtree of the comment, nested, fetched with one range query.
+        """
+        params = TreeParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        node = self.get_object()
+        max_depth = params.validated_data.get('max_depth')
+        max_level = None if max_depth is None else node.level + max_depth
+        return Response(self.get_tree(tree_storage().subtree(node), params.validated_data, max_level)[0])
+
+    @action(detail=False, url_path='tree')
+    def object_tree(self, request):
+        """
+        All comment threads of ``content_type`` / ``object_id``, nested, fetched with one query.
+        """
+        params = ObjectTreeParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        nodes = Comment.objects.filter(
+            content_type=params.validated_data['content_type'],
+            object_id=params.validated_data['object_id'],
+        ).order_by(*tree_storage().ordering)
+        max_depth = params.validated_data.get('max_depth')
+        return Response(self.get_tree(nodes, params.validated_data, max_depth))
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Create a list of comments at once. Replies to comments of the same
+        batch give the index of their parent in the list as ``parent_index``.
+        """
+        serializer = BulkCommentSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        comments = serializer.save()
+        return Response({'ids': [comment.pk for comment in comments]}, status=status.HTTP_201_CREATED)
+
+    @action(detail=False)
+    def counts(self, request):
+        """
+        Comment counts of many objects of ``content_type`` at once, by ``object_id``.
+        """
+        params = CountsParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        return Response(CommentCounter.objects.counts(params.validated_data['content_type'],
+                                                      params.validated_data['object_id']))
+
+
+class PostSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    comment_count = serializers.SerializerMethodField()
 
-class PostSerializer(serializers.ModelSerializer):
     class Meta:
         model = Post
-        fields = ('id', 'text', 'url')
+        fields = ('id', 'text', 'url', 'comment_count')
+
+    def get_comment_count(self, obj):
+        if hasattr(obj, 'comment_count'):
+            return obj.comment_count
+        return CommentCounter.objects.counts(ContentType.objects.get_for_model(Post), [obj.pk])[obj.pk]
 
 
 class PostViewSet(UpdateModelMixin, viewsets.ModelViewSet):
     queryset = Post.objects.all()
     serializer_class = PostSerializer
 
+    def get_queryset(self):
+        counter = CommentCounter.objects.filter(content_type=ContentType.objects.get_for_model(Post),
+                                                object_id=OuterRef('pk'))
+        return super().get_queryset().annotate(comment_count=Coalesce(Subquery(counter.values('count')), 0))
+
 
-class HistoryFileSerializer(serializers.ModelSerializer):
-    content_type = serializers.PrimaryKeyRelatedField(queryset=ContentTypeViewSet.queryset)
+class HistoryFileSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    content_type = ContentTypeField(commentable)
     user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), html_cutoff_text=_HTML_CUTOFF_TEXT,
                                               html_cutoff=10)
 
     class Meta:
         model = CommentsHistory
         fields = ('id', 'url', 'user', 'created', 'content_type', 'object_id',
-                  'date_from', 'date_to', 'format', 'file', 'status')
-        read_only_fields = ('created', 'file', 'status')
+                  'date_from', 'date_to', 'format', 'file', 'status', 'shards', 'shards_done',
+                  'incremental', 'previous', 'last_comment_id', 'started', 'queue_time', 'duration',
+                  'rows_exported', 'query_time', 'serialize_time', 'write_time')
+        read_only_fields = ('created', 'file', 'status', 'shards_done', 'previous', 'last_comment_id')
+        extra_kwargs = {'shards': {'min_value': 1, 'max_value': settings.COMMENTS_EXPORT_MAX_SHARDS}}
+
+    def validate_format(self, value):
+        if not is_available(value):
+            raise serializers.ValidationError(f'Format "{value}" is not available on this server.')
+        return value
+
+    def validate(self, data):
+        if data.get('incremental') and data.get('date_to'):
+            raise serializers.ValidationError({'incremental': 'Only open-ended exports (without date_to) '
+                                                              'can be incremental'})
+        return data
 
 
 class HistoryFileViewSet(mixins.CreateModelMixin,
@@ -145,9 +322,65 @@ class HistoryFileViewSet(mixins.CreateModelMixin,
     queryset = CommentsHistory.objects.all()
     serializer_class = HistoryFileSerializer
 
-    def perform_create(self, serializer: HistoryFileSerializer):
-        instance = serializer.save()
-        export_comments_history.delay(str(instance.id))
+    def create(self, request, *args, **kwargs):
+        """
+        Start an export, or return the matching one that is running or still
+        up to date instead.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        params_hash = CommentsHistory(**serializer.validated_data).get_params_hash()
+        with transaction.atomic():
+            CommentsHistory.objects.lock_params(params_hash)
+            existing = CommentsHistory.objects.reusable(params_hash)
+            if existing is None:
+                previous = None
+                if serializer.validated_data.get('incremental'):
+                    previous = CommentsHistory.objects.last_increment(params_hash)
+                self.perform_create(serializer, previous=previous)
+        if existing is not None:
+            return Response(self.get_serializer(existing).data, status=status.HTTP_200_OK)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+    def perform_create(self, serializer: HistoryFileSerializer, **kwargs):
+        instance = serializer.save(**kwargs)
+        transaction.on_commit(lambda: export_comments_history.delay(str(instance.id)))
+
+    @action(detail=False, methods=['post'])
+    def download(self, request):
+        """
+        Stream small exports right away, without Celery and without a file;
+        exports over ``COMMENTS_EXPORT_STREAM_MAX_ROWS`` comments are started
+        as usual instead.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = dict(serializer.validated_data)
+        data.pop('incremental', None)
+        obj = CommentsHistory(**data)
+        comments = obj.get_comments()
+        if comments[:settings.COMMENTS_EXPORT_STREAM_MAX_ROWS + 1].count() > settings.COMMENTS_EXPORT_STREAM_MAX_ROWS:
+            return self.create(request)
+
+        chunks = iterdump_chunks(obj.format, obj.serialized_comments(comments), settings.COMMENTS_EXPORT_CHUNK_SIZE)
+        response = StreamingHttpResponse(chunks, content_type=content_type(obj.format))
+        response['Content-Disposition'] = f'attachment; filename="comments.{obj.format}"'
+        return response
+
+    @action(detail=True)
+    def manifest(self, request, pk=None):
+        """
+        Files to apply in order to rebuild the history an incremental export
+        belongs to: the full export first, then the deltas up to this one.
+        Deltas may repeat the last comments of the export before them.
+        """
+        chain = self.get_object().get_chain()
+        complete = chain[0].previous_id is None and all(obj.status == Status.success for obj in chain)
+        return Response({
+            'complete': complete,
+            'exports': self.get_serializer(chain, many=True).data,
+        })
 
 
 router.register(r'contenttypes', ContentTypeViewSet)
@@ -1,22 +1,89 @@
+import time
+
+import jwt
 from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
+from django.utils.functional import LazyObject
 from rest_framework_jwt.authentication import jwt_decode_handler
 
+from core.utils import TTLCache
+
+
+def get_token(scope):
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            return value.decode()
+    return None
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    """
+    Populate ``scope["user"]`` from the JWT in the ``Authorization`` header.
+
+    Users are cached by token for ``CHANNELS_JWT_CACHE_TTL`` seconds at most
+    and never past the token expiry, the database is only queried on a miss
+    and off the event loop.
+    """
+    cache = TTLCache(settings.CHANNELS_JWT_CACHE_SIZE, settings.CHANNELS_JWT_CACHE_TTL)
+
+    def populate_scope(self, scope):
+        if get_token(scope) is not None:
+            scope['user'] = LazyObject()
+
+    async def resolve_scope(self, scope):
+        token = get_token(scope)
+        if token is not None:
+            scope['user']._wrapped = await self.get_user(token)
+
+    async def get_user(self, token):
+        user = self.cache.get(token)
+        if user is not None:
+            return user
+        try:
+            payload = jwt_decode_handler(token)
+        except jwt.InvalidTokenError:
+            return AnonymousUser()
+        user = await database_sync_to_async(self.load_user)(payload)
+        ttl = payload['exp'] - time.time() if 'exp' in payload else None
+        self.cache.set(token, user, ttl)
+        return user
+
+    @staticmethod
+    def load_user(payload):
+        try:
+            return User.objects.get_by_natural_key(payload['username'])
+        except User.DoesNotExist:
+            return AnonymousUser()
+
 
-class TokenAuthMiddleware:
+class SessionFallbackMiddleware:
+    """
+    Send connections carrying a JWT straight to ``token_auth``, sparing them
+    the session and user lookups of the session stack that others go through.
+    """
 
-    def __init__(self, inner):
-        self.inner = inner
+    def __init__(self, token_auth):
+        self.token_auth = token_auth
+        self.session_auth = AuthMiddlewareStack(token_auth)
 
     def __call__(self, scope):
-        headers = dict(scope['headers'])
-        if b'authorization' in headers:
-            try:
-                user = jwt_decode_handler(headers[b'authorization'].decode())
-                scope['user'] = User.objects.get_by_natural_key(user['username'])
-            except User.DoesNotExist:
-                scope['user'] = AnonymousUser()
-        return self.inner(scope)
+        if get_token(scope) is not None:
+            return self.token_auth(scope)
+        return self.session_auth(scope)
 
 
-TokenAuthMiddlewareStack = lambda inner: TokenAuthMiddleware(AuthMiddlewareStack(inner))
+def TokenAuthMiddlewareStack(inner, skip_session=None):
+    """
+    JWT authentication falling back to the session, the session stack is
+    skipped for connections with a JWT when ``skip_session`` (by default
+    ``CHANNELS_JWT_SKIP_SESSION``) is set.
+    """
+    if skip_session is None:
+        skip_session = settings.CHANNELS_JWT_SKIP_SESSION
+    token_auth = TokenAuthMiddleware(inner)
+    if skip_session:
+        return SessionFallbackMiddleware(token_auth)
+    return AuthMiddlewareStack(token_auth)
@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import Http404, HttpResponse
+
+from core import metrics
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+request_duration = metrics.histogram('comments_http_request_duration_seconds', 'Time spent handling requests')
+request_db_time = metrics.histogram('comments_http_request_db_seconds', 'Time spent in SQL queries per request')
+request_serialize_time = metrics.histogram('comments_http_request_serialize_seconds',
+                                           'Time spent serializing and rendering response data per request')
+request_queries = metrics.histogram('comments_http_request_queries', 'SQL queries per request',
+                                    (1, 2, 5, 10, 20, 50, 100, 200, 500))
+response_size = metrics.histogram('comments_http_response_size_bytes', 'Size of response bodies',
+                                  (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.serializing = False
+        self.render_started = None
+
+    def record_query(self, execute, sql, params, many, context):
+        """
+        Database execute wrapper counting queries and their time.
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started
+
+    def rendered(self, response):
+        self.serialize_time += time.perf_counter() - self.render_started
+
+
+def current_stats():
+    """
+    Stats of the request handled by this thread, if any.
+    """
+    return getattr(_local, 'stats', None)
+
+
+class TimedSerializerMixin:
+    """
+    Count the time spent in ``to_representation`` as serialization time of
+    the current request. Nested serializers are only counted once.
+    """
+
+    def to_representation(self, instance):
+        stats = current_stats()
+        if stats is None or stats.serializing:
+            return super().to_representation(instance)
+        stats.serializing = True
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            stats.serialize_time += time.perf_counter() - started
+            stats.serializing = False
+
+
+def query_budget(view_name):
+    budget = settings.INSTRUMENTATION_QUERY_BUDGET
+    if isinstance(budget, dict):
+        return budget.get(view_name, budget.get('default'))
+    return budget
+
+
+class InstrumentationMiddleware:
+    """
+    Record query count, database, serialization and total time, and response
+    size per view. They are sent back in a ``Server-Timing`` header and kept
+    as metrics, see ``metrics_view``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = _local.stats = RequestStats()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats.record_query))
+                response = self.get_response(request)
+        finally:
+            _local.stats = None
+        duration = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unmatched'
+        labels = {'view': view, 'method': request.method}
+        request_duration.observe(duration, **labels)
+        request_db_time.observe(stats.db_time, **labels)
+        request_serialize_time.observe(stats.serialize_time, **labels)
+        request_queries.observe(stats.queries, **labels)
+        if not response.streaming:
+            response_size.observe(len(response.content), **labels)
+        response['Server-Timing'] = (f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", '
+                                     f'serialize;dur={stats.serialize_time * 1000:.1f}, '
+                                     f'total;dur={duration * 1000:.1f}')
+
+        budget = query_budget(view)
+        if budget is not None and stats.queries > budget:
+            message = f'{request.method} {request.path} ({view}) ran {stats.queries} queries, budget is {budget}'
+            if settings.INSTRUMENTATION_QUERY_BUDGET_RAISE:
+                raise QueryBudgetExceeded(message)
+            log.warning(message)
+        return response
+
+    def process_template_response(self, request, response):
+        # Called right before DRF renders the response data
+        stats = current_stats()
+        if stats is not None:
+            stats.render_started = time.perf_counter()
+            response.add_post_render_callback(stats.rendered)
+        return response
+
+
+def metrics_view(request):
+    """
+    Metrics of this process in the Prometheus text format, for ``INTERNAL_IPS`` only.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
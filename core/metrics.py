@@ -0,0 +1,134 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+_registry = {}
+_collectors = []
+_lock = threading.Lock()
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in labels) + '}'
+
+
+class Metric:
+    """
+    Values by set of labels, an unlabelled metric has a single one.
+    """
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def header(self):
+        return f'# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.type}\n'
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values) or {(): 0}
+        return self.header() + ''.join(f'{self.name}{_labels(key)} {value}\n' for key, value in values.items())
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Observations counted in cumulative ``buckets``, one series per set of labels.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets):
+        super().__init__(name, documentation)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with self.lock:
+            # Counts per bucket, then the total count and sum
+            series = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        with self.lock:
+            series = [(key, list(values)) for key, values in self.values.items()]
+        lines = [self.header()]
+        for key, values in series:
+            for bound, count in zip(self.buckets + ['+Inf'], values[:-1]):
+                lines.append(f'{self.name}_bucket{_labels(key + (("le", bound),))} {count}\n')
+            lines.append(f'{self.name}_count{_labels(key)} {values[-2]}\n')
+            lines.append(f'{self.name}_sum{_labels(key)} {values[-1]}\n')
+        return ''.join(lines)
+
+
+def _get(cls, name, documentation, *args):
+    with _lock:
+        if name not in _registry:
+            _registry[name] = cls(name, documentation, *args)
+        return _registry[name]
+
+
+def counter(name, documentation=''):
+    return _get(Counter, name, documentation)
+
+
+def gauge(name, documentation=''):
+    return _get(Gauge, name, documentation)
+
+
+def histogram(name, documentation='', buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+    return _get(Histogram, name, documentation, buckets)
+
+
+def collector(func):
+    """
+    Register ``func``, returning metrics computed at scrape time, e.g. from
+    the database for work done in other processes.
+    """
+    _collectors.append(func)
+    return func
+
+
+def render():
+    """
+    All metrics of this process in the Prometheus text format.
+    """
+    collected = []
+    for func in list(_collectors):
+        try:
+            collected.extend(func())
+        except Exception:
+            log.warning('Metrics collector %s failed', func.__name__, exc_info=True)
+    return ''.join(metric.render() for metric in list(_registry.values()) + collected)
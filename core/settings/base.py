@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,6 +56,14 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'core.urls'
 
+# Clients allowed to read /metrics
+INTERNAL_IPS = ['127.0.0.1']
+# Maximal number of SQL queries per request, either one number or a dict by
+# view name with an optional 'default'. Requests going over it are logged,
+# or fail when INSTRUMENTATION_QUERY_BUDGET_RAISE is set (in tests)
+INSTRUMENTATION_QUERY_BUDGET = None
+INSTRUMENTATION_QUERY_BUDGET_RAISE = False
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -139,6 +148,11 @@ REST_FRAMEWORK = {
 }
 
 ASGI_APPLICATION = "core.routing.application"
+# WebSocket users are cached by JWT for this many seconds
+CHANNELS_JWT_CACHE_TTL = 60
+CHANNELS_JWT_CACHE_SIZE = 10000
+# Connections with a JWT skip the session and cookie lookups
+CHANNELS_JWT_SKIP_SESSION = False
 
 CHANNEL_LAYERS = {
     "default": {
@@ -149,4 +163,68 @@ CHANNEL_LAYERS = {
     },
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'comments': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://localhost:16379/10',
+        'OPTIONS': {
+            # Serve uncached rather than fail when Redis is away
+            'IGNORE_EXCEPTIONS': True,
+        },
+    },
+}
+
 CELERY_BROKER_URL = 'redis://localhost:16379/8'
+# Needed by chords of sharded exports
+CELERY_RESULT_BACKEND = 'redis://localhost:16379/9'
+
+# How comment threads are stored: 'mptt' (nested sets) or 'path' (materialized
+# paths, cheap reply inserts). Migrations set up the indexes of mptt mode, run
+# the migrate_comment_tree command after migrate when switching
+COMMENTS_TREE_STORAGE = 'mptt'
+# Deepest level of replies accepted, roots are at level 0. Materialized paths
+# take 10 characters per level and must fit in an index entry.
+COMMENTS_MAX_LEVEL = 255
+# Maximal number of comments per POST /comments/bulk/
+COMMENTS_BULK_MAX_BATCH = 10000
+# Users and commented objects known to exist are not looked up again for
+# this many seconds when validating new comments
+COMMENTS_KNOWN_OBJECTS_CACHE_TTL = 60
+COMMENTS_KNOWN_OBJECTS_CACHE_SIZE = 10000
+# Cache of comment list and detail responses, invalidated by version keys
+COMMENTS_RESPONSE_CACHE = 'comments'
+COMMENTS_RESPONSE_CACHE_TTL = 5 * 60
+# Responses also kept in each process, in front of the shared cache
+COMMENTS_RESPONSE_CACHE_LOCAL_SIZE = 1000
+
+# Rows fetched per round trip from the server-side cursor while exporting
+COMMENTS_EXPORT_CHUNK_SIZE = 2000
+# Upper bound for the number of parallel parts of one export
+COMMENTS_EXPORT_MAX_SHARDS = 32
+# Finished exports are reused for identical requests until they are older than
+# this many seconds or pushed out by newer ones beyond this many bytes on disk
+COMMENTS_EXPORT_CACHE_MAX_AGE = 24 * 60 * 60
+COMMENTS_EXPORT_CACHE_MAX_SIZE = 1024 ** 3
+# Incremental exports repeat the comments created up to this many seconds
+# before the previous export started, which may have been committed after it
+# read its rows. Comments of longer transactions can still be missed.
+COMMENTS_EXPORT_COMMIT_GRACE = 60
+# Exports still unfinished after this many seconds are taken for lost (task
+# lost by the broker, worker crash): identical requests start a new one and
+# eviction marks them failed
+COMMENTS_EXPORT_MAX_RUNNING_TIME = 60 * 60
+# Exports of at most this many comments can be streamed straight from
+# /comments_history/download/, bigger ones go through Celery
+COMMENTS_EXPORT_STREAM_MAX_ROWS = 10000
+# Minimal delay in seconds between progress notifications of a running export
+COMMENTS_EXPORT_PROGRESS_INTERVAL = 1
+# Maximal number of objects in one batched (un)subscribe message
+COMMENTS_WS_MAX_BATCH = 500
+# WebSocket clients with more events than this waiting to be sent are disconnected
+COMMENTS_WS_SEND_QUEUE_SIZE = 1000
+# Updates of one object published within this many seconds reach
+# subscribers once, with the latest state
+COMMENTS_FANOUT_WINDOW = 0.2
@@ -18,4 +18,7 @@ CHANNEL_LAYERS = {
     },
 }
 
+CACHES['comments']['LOCATION'] = 'redis://redis:6379/10'
+
 CELERY_BROKER_URL = 'redis://redis:6379/8'
+CELERY_RESULT_BACKEND = 'redis://redis:6379/9'
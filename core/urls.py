@@ -6,9 +6,11 @@ from django.urls import path, include
 from rest_framework_jwt.views import obtain_jwt_token
 
 from comments.views import router
+from core.instrumentation import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view),
     url(r'^', include(router.urls)),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     url(r'^api-token-auth/', obtain_jwt_token),
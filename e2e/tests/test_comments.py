@@ -1,11 +1,23 @@
+import csv
+import datetime
+import gzip
 import io
+import json
 import xml.etree.ElementTree as ET
 
 import pytest
 import requests
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from requests.auth import HTTPBasicAuth
 
-from comments.models import Comment
+from comments.cache import get_versions, object_version_key
+from comments.events import COMMENT_CREATED, publisher
+from comments.export import iterload_columnar
+from comments.models import Comment, CommentsHistory, Status
 
 
 @pytest.fixture(scope='module')
@@ -78,6 +90,20 @@ def test_comments(live_server, session, user, post, content_types):
     })
     assert res.json()['text'] == 'asdasdasdasdasdasd'
 
+    # try move leaf comment
+    res = session.put(f'{live_server}/comments/{leaf_comment["id"]}/', json={
+        **leaf_comment,
+        "parent": None,
+    })
+    assert res.status_code == 400
+    assert res.json() == {'parent': ['Can not be changed.']}
+    res = session.put(f'{live_server}/comments/{leaf_comment["id"]}/', json={
+        **leaf_comment,
+        "object_id": post['id'] + 1,
+    })
+    assert res.status_code == 400
+    assert res.json() == {'object_id': ['Can not be changed.']}
+
     # try delete comment which has children
     res = session.delete(f'{live_server}/comments/{root_comment["id"]}/')
     assert res.json() == ['Can not delete comment, comment has children.']
@@ -100,24 +126,29 @@ def test_select_comments_by_user(live_server, session, user):
 
 @pytest.mark.timeout(10)
 @pytest.mark.parametrize('format', ['json', 'xml'])
-def test_export_history(live_server, session, user, content_types, post, format):
+@pytest.mark.parametrize('shards', [1, 3])
+def test_export_history(live_server, session, user, content_types, post, format, shards):
     res = session.post(f'{live_server}/comments_history/', json={
         "user": user['id'],
         "content_type": content_types['comments.post']['id'],
         "object_id": post['id'],
         "date_from": None,
         "date_to": None,
-        "format": format
+        "format": format,
+        "shards": shards
     }).json()
     assert res['file'] is None
 
     while not res['file']:
         res = session.get(f'{live_server}/comments_history/{res["id"]}').json()
     assert res['file']
+    assert res['shards_done'] == (res['shards'] if shards > 1 else 0)
 
     expected_count = Comment.objects.filter(user_id=user['id'],
                                                   content_type=content_types['comments.post']['id'],
                                                   object_id=post['id']).count()
+    assert res['rows_exported'] == expected_count
+    assert res['duration'] is not None and res['queue_time'] is not None
     if format == 'json':
         res = session.get(res['file']).json()
         assert len(res) == expected_count
@@ -125,3 +156,355 @@ def test_export_history(live_server, session, user, content_types, post, format)
         res = session.get(res['file'])
         tree = ET.parse(io.BytesIO(res.content))
         assert len(tree.findall('list-item')) == expected_count
+
+
+@pytest.mark.parametrize('ordering', ['thread', 'created'])
+def test_cursor_pagination(live_server, session, post, content_types, ordering):
+    params = {
+        'content_type': content_types['comments.post']['id'],
+        'object_id': post['id'],
+        'pagination': 'cursor',
+        'ordering': ordering,
+        'limit': 3,
+    }
+    expected = list(Comment.objects.filter(content_type=params['content_type'], object_id=params['object_id'])
+                    .order_by(*{'thread': ('tree_id', 'lft'), 'created': ('created', 'id')}[ordering])
+                    .values_list('id', flat=True))
+
+    res = session.get(f'{live_server}/comments/', params=params).json()
+    assert 'count' not in res
+    assert res['previous'] is None
+    ids = [c['id'] for c in res['results']]
+    while res['next']:
+        res = session.get(res['next']).json()
+        ids += [c['id'] for c in res['results']]
+    assert ids == expected
+
+    # walk back from the last page
+    back = [c['id'] for c in res['results']]
+    while res['previous']:
+        res = session.get(res['previous']).json()
+        back = [c['id'] for c in res['results']] + back
+    assert back == expected
+
+
+def test_cursor_pagination_invalid_cursor(live_server, session):
+    res = session.get(f'{live_server}/comments/', params={'cursor': 'garbage'})
+    assert res.status_code == 404
+
+
+def test_comment_tree(live_server, session, user, post, content_types):
+    def create(parent=None):
+        return session.post(f'{live_server}/comments/', json={
+            "user": user['id'],
+            "text": "tree",
+            "parent": parent,
+            "content_type": content_types['comments.post']['id'],
+            "object_id": post['id']
+        }).json()
+
+    root = create()
+    children = [create(root['id']) for _ in range(3)]
+    grandchild = create(children[0]['id'])
+
+    tree = session.get(f'{live_server}/comments/{root["id"]}/tree/').json()
+    assert tree['id'] == root['id']
+    assert [c['id'] for c in tree['children']] == [c['id'] for c in children]
+    assert [c['id'] for c in tree['children'][0]['children']] == [grandchild['id']]
+    assert not tree['truncated']
+
+    tree = session.get(f'{live_server}/comments/{root["id"]}/tree/', params={'max_children': 2}).json()
+    assert [c['id'] for c in tree['children']] == [c['id'] for c in children[:2]]
+    assert tree['truncated']
+
+    tree = session.get(f'{live_server}/comments/{root["id"]}/tree/', params={'max_depth': 1}).json()
+    assert tree['children'][0]['children'] == []
+    assert tree['children'][0]['truncated']
+
+    threads = session.get(f'{live_server}/comments/tree/', params={
+        'content_type': content_types['comments.post']['id'],
+        'object_id': post['id'],
+    }).json()
+    assert threads[-1]['id'] == root['id']
+    assert len(threads) == Comment.objects.filter(content_type=content_types['comments.post']['id'],
+                                                  object_id=post['id'], parent=None).count()
+
+
+def test_comment_counts(live_server, session, user, post, content_types):
+    def count():
+        return session.get(f'{live_server}/posts/{post["id"]}/').json()['comment_count']
+
+    before = count()
+    root = session.post(f'{live_server}/comments/', json={
+        "user": user['id'],
+        "text": "counted",
+        "parent": None,
+        "content_type": content_types['comments.post']['id'],
+        "object_id": post['id']
+    }).json()
+    reply = session.post(f'{live_server}/comments/', json={**root, "parent": root['id']}).json()
+    assert root['reply_count'] == 0
+    assert session.get(f'{live_server}/comments/{root["id"]}/').json()['reply_count'] == 1
+    assert count() == before + 2
+
+    counts = session.get(f'{live_server}/comments/counts/', params={
+        'content_type': content_types['comments.post']['id'],
+        'object_id': [post['id'], 0],
+    }).json()
+    assert counts == {str(post['id']): before + 2, '0': 0}
+
+    session.delete(f'{live_server}/comments/{reply["id"]}/')
+    assert session.get(f'{live_server}/comments/{root["id"]}/').json()['reply_count'] == 0
+    assert count() == before + 1
+    assert count() == Comment.objects.filter(content_type=content_types['comments.post']['id'],
+                                             object_id=post['id']).count()
+
+
+def test_bulk_create(live_server, session, user, post, content_types):
+    comment = {
+        "user": user['id'],
+        "text": "bulk",
+        "content_type": content_types['comments.post']['id'],
+        "object_id": post['id']
+    }
+    res = session.post(f'{live_server}/comments/bulk/', json=[comment, {**comment, "parent_index": 2}])
+    assert res.status_code == 400
+    assert res.json() == [{}, {'parent_index': ['Must refer to an earlier comment of the batch.']}]
+
+    root, reply, nested = session.post(f'{live_server}/comments/bulk/', json=[
+        comment,
+        {**comment, "parent_index": 0},
+        {**comment, "parent_index": 1},
+    ]).json()['ids']
+    tree = session.get(f'{live_server}/comments/{root}/tree/').json()
+    assert tree['reply_count'] == 1
+    assert [c['id'] for c in tree['children']] == [reply]
+    assert [c['id'] for c in tree['children'][0]['children']] == [nested]
+
+    chain = [comment] + [{**comment, "parent_index": index} for index in range(settings.COMMENTS_MAX_LEVEL + 1)]
+    res = session.post(f'{live_server}/comments/bulk/', json=chain)
+    assert res.status_code == 400
+    assert res.json()[-1] == {
+        'parent_index': [f'Replies can be nested at most {settings.COMMENTS_MAX_LEVEL} levels deep.']}
+
+
+def test_import_comments(user, post, content_types, tmpdir, monkeypatch):
+    events = []
+    monkeypatch.setattr(publisher, 'send', lambda key, group, message: events.append(message))
+    post_type = content_types['comments.post']['id']
+    before = get_versions([object_version_key(post_type, post['id'])])
+    comment = {"user": user['id'], "text": "imported", "content_type": post_type, "object_id": post['id']}
+    file = tmpdir.join('comments.jsonl')
+    file.write('\n'.join(json.dumps(row) for row in [{**comment, "ref": "root"}, {**comment, "parent_ref": "root"}]))
+
+    call_command('import_comments', str(file), stdout=io.StringIO())
+    root, reply = Comment.objects.order_by('-pk')[:2][::-1]
+    assert reply.parent_id == root.pk
+    # Like comments created through the API
+    assert get_versions([object_version_key(post_type, post['id'])]) != before
+    assert [(event['type'], event['content_type'], event['object_id'], event['data']['id']) for event in events] == [
+        (COMMENT_CREATED, post_type, post['id'], root.pk),
+        (COMMENT_CREATED, post_type, post['id'], reply.pk),
+        (COMMENT_CREATED, ContentType.objects.get_for_model(Comment).pk, root.pk, reply.pk),
+    ]
+    assert events[1]['data']['parent'] == root.pk
+
+
+def test_comment_response_cache(live_server, session, user, post, content_types):
+    params = {'content_type': content_types['comments.post']['id'], 'object_id': post['id'], 'limit': 1000}
+
+    def list_comments():
+        res = session.get(f'{live_server}/comments/', params=params)
+        return res.headers['X-Cache'], [c['id'] for c in res.json()['results']]
+
+    list_comments()
+    cache, ids = list_comments()
+    assert cache == 'hit'
+
+    root = session.post(f'{live_server}/comments/', json={
+        "user": user['id'],
+        "text": "cached",
+        "parent": None,
+        "content_type": content_types['comments.post']['id'],
+        "object_id": post['id']
+    }).json()
+    cache, new_ids = list_comments()
+    assert cache == 'miss'
+    assert new_ids == ids + [root['id']]
+
+    session.get(f'{live_server}/comments/{root["id"]}/')
+    res = session.get(f'{live_server}/comments/{root["id"]}/')
+    assert res.headers['X-Cache'] == 'hit'
+    session.put(f'{live_server}/comments/{root["id"]}/', json={**root, "text": "edited"})
+    res = session.get(f'{live_server}/comments/{root["id"]}/')
+    assert res.headers['X-Cache'] == 'miss'
+    assert res.json()['text'] == 'edited'
+    session.post(f'{live_server}/comments/', json={**root, "parent": root['id']})
+    res = session.get(f'{live_server}/comments/{root["id"]}/')
+    assert res.headers['X-Cache'] == 'miss'
+    assert res.json()['reply_count'] == 1
+
+
+def test_request_instrumentation(live_server, session, post, content_types):
+    res = session.get(f'{live_server}/comments/', params={
+        'content_type': content_types['comments.post']['id'], 'object_id': post['id']})
+    timings = {part.split(';')[0].strip(): part for part in res.headers['Server-Timing'].split(',')}
+    assert set(timings) == {'db', 'serialize', 'total'}
+    assert 'queries"' in timings['db']
+
+    metrics = session.get(f'{live_server}/metrics').text
+    assert 'comments_http_request_queries_count{method="GET",view="comment-list"}' in metrics
+    assert '# TYPE comments_http_request_duration_seconds histogram' in metrics
+
+
+def _load_export(format, content):
+    if format.endswith('.gz'):
+        format = format[:-len('.gz')]
+        # media is served with "Content-Encoding: gzip", so requests may have decoded it already
+        if content.startswith(b'\x1f\x8b'):
+            content = gzip.decompress(content)
+    if format == 'jsonl':
+        return [json.loads(line) for line in content.decode('utf-8').splitlines()]
+    if format == 'csv':
+        return list(csv.DictReader(io.StringIO(content.decode('utf-8'), newline='')))
+    if format == 'columnar':
+        return list(iterload_columnar(io.BytesIO(content)))
+
+
+@pytest.mark.timeout(10)
+@pytest.mark.parametrize('format', ['jsonl', 'csv', 'jsonl.gz', 'csv.gz', 'columnar'])
+@pytest.mark.parametrize('shards', [1, 2])
+def test_export_history_formats(live_server, session, user, content_types, post, format, shards):
+    res = session.post(f'{live_server}/comments_history/', json={
+        "user": user['id'],
+        "content_type": content_types['comments.post']['id'],
+        "object_id": post['id'],
+        "format": format,
+        "shards": shards
+    }).json()
+    while not res['file']:
+        res = session.get(f'{live_server}/comments_history/{res["id"]}').json()
+
+    expected = list(Comment.objects.filter(user_id=user['id'],
+                                           content_type=content_types['comments.post']['id'],
+                                           object_id=post['id']).values_list('id', flat=True))
+    rows = _load_export(format, session.get(res['file']).content)
+    assert sorted(int(row['id']) for row in rows) == sorted(expected)
+
+
+@pytest.mark.timeout(10)
+def test_export_history_reuse(live_server, session, user, content_types, post):
+    params = {
+        "user": user['id'],
+        "content_type": content_types['comments.post']['id'],
+        "object_id": post['id'],
+        "date_to": "2000-01-01T00:00:00Z",
+        "format": 'json'
+    }
+    res = session.post(f'{live_server}/comments_history/', json=params)
+    first = res.json()
+    while not first['file']:
+        first = session.get(f'{live_server}/comments_history/{first["id"]}').json()
+
+    res = session.post(f'{live_server}/comments_history/', json=params)
+    assert res.status_code == 200
+    assert res.json()['id'] == first['id']
+
+    # Deleted comments leave no trace in the range, but outdate the export
+    comment = session.post(f'{live_server}/comments/', json={**params, "text": "deleted", "parent": None}).json()
+    session.delete(f'{live_server}/comments/{comment["id"]}/')
+    res = session.post(f'{live_server}/comments_history/', json=params)
+    assert res.status_code == 201
+    assert res.json()['id'] != first['id']
+
+    res = session.post(f'{live_server}/comments_history/', json={**params, 'format': 'xml'})
+    assert res.status_code == 201
+    assert res.json()['id'] != first['id']
+
+
+@pytest.mark.timeout(10)
+def test_export_history_stale(live_server, session, user, content_types, post):
+    params = {
+        "user": user['id'],
+        "content_type": content_types['comments.post']['id'],
+        "object_id": post['id'],
+        "date_to": "2001-01-01T00:00:00Z",
+        "format": 'json'
+    }
+    # Its task was lost long ago
+    stale = CommentsHistory.objects.create(user_id=user['id'], content_type_id=params['content_type'],
+                                           object_id=post['id'], date_to=parse_datetime(params['date_to']),
+                                           format='json', status=Status.pending)
+    CommentsHistory.objects.filter(pk=stale.pk).update(
+        created=timezone.now() - datetime.timedelta(seconds=settings.COMMENTS_EXPORT_MAX_RUNNING_TIME + 1))
+
+    res = session.post(f'{live_server}/comments_history/', json=params)
+    assert res.status_code == 201
+    assert res.json()['id'] != str(stale.pk)
+
+    call_command('evict_exports', stdout=io.StringIO())
+    stale.refresh_from_db()
+    assert stale.status == Status.error
+
+
+@pytest.mark.timeout(10)
+def test_export_history_incremental(live_server, session, user, content_types, post):
+    params = {
+        "user": user['id'],
+        "content_type": content_types['comments.post']['id'],
+        "object_id": post['id'],
+        "format": 'jsonl',
+        "incremental": True
+    }
+
+    def export():
+        res = session.post(f'{live_server}/comments_history/', json=params).json()
+        while not res['file']:
+            res = session.get(f'{live_server}/comments_history/{res["id"]}').json()
+        return res, [json.loads(line) for line in session.get(res['file']).text.splitlines()]
+
+    full, full_rows = export()
+    assert full_rows
+    assert full['last_comment_id'] == max(row['id'] for row in full_rows)
+
+    comment = session.post(f'{live_server}/comments/', json={
+        "user": user['id'],
+        "text": "new",
+        "parent": None,
+        "content_type": content_types['comments.post']['id'],
+        "object_id": post['id']
+    }).json()
+
+    delta, delta_rows = export()
+    assert delta['previous'] == full['id']
+    # Along with the last comments of the full export, in case they were committed late
+    assert delta_rows[-1]['id'] == comment['id']
+    assert {row['id'] for row in delta_rows[:-1]} <= {row['id'] for row in full_rows}
+
+    manifest = session.get(f'{live_server}/comments_history/{delta["id"]}/manifest/').json()
+    assert [e['id'] for e in manifest['exports'][-2:]] == [full['id'], delta['id']]
+    assert manifest['complete']
+
+    res = session.post(f'{live_server}/comments_history/', json={**params, 'date_to': '2000-01-01T00:00:00Z'})
+    assert res.status_code == 400
+
+
+@pytest.mark.parametrize('format', ['json', 'csv'])
+def test_export_history_download(live_server, session, user, content_types, post, format):
+    res = session.post(f'{live_server}/comments_history/download/', json={
+        "user": user['id'],
+        "content_type": content_types['comments.post']['id'],
+        "object_id": post['id'],
+        "format": format
+    })
+    assert res.status_code == 200
+    assert 'attachment' in res.headers['Content-Disposition']
+
+    expected = list(Comment.objects.filter(user_id=user['id'],
+                                           content_type=content_types['comments.post']['id'],
+                                           object_id=post['id']).values_list('id', flat=True))
+    if format == 'json':
+        rows = res.json()
+    else:
+        rows = list(csv.DictReader(io.StringIO(res.content.decode('utf-8'), newline='')))
+    assert sorted(int(row['id']) for row in rows) == sorted(expected)
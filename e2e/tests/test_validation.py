@@ -0,0 +1,100 @@
+import pytest
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework import serializers
+
+from comments.bulk import check_comments
+from comments.models import Comment, CommentsHistory, Post
+from comments.registry import commentable, subscribable
+from comments.validation import ContentTypeField, known_objects, object_exists
+from comments.views import CommentSerializer
+
+
+@pytest.fixture()
+def post():
+    post = Post.objects.create(text='validated')
+    yield post
+    Post.objects.filter(pk=post.pk).delete()
+
+
+def comment_data(post):
+    return {'user': User.objects.get(username='admin').pk, 'text': 'validated', 'parent': None,
+            'content_type': ContentType.objects.get_for_model(Post).pk, 'object_id': post.pk}
+
+
+def test_object_exists_cached(post):
+    known_objects.clear()
+    with CaptureQueriesContext(connection) as queries:
+        assert object_exists(Post, post.pk)
+        assert object_exists(Post, post.pk)
+    assert len(queries) == 1
+    assert not object_exists(Post, 0)
+    # Misses are never remembered
+    assert known_objects.get(('comments.post', 0)) is None
+
+
+def test_deleted_object_forgotten(post):
+    data = comment_data(post)
+    assert CommentSerializer(data=data).is_valid()
+    assert known_objects.get(('comments.post', post.pk))
+
+    post.delete()
+    assert known_objects.get(('comments.post', data['object_id'])) is None
+    serializer = CommentSerializer(data=data)
+    assert not serializer.is_valid()
+    assert list(serializer.errors) == ['object_id']
+    _, errors = check_comments([{**data, 'parent': None}], commentable)
+    assert list(errors[0]) == ['object_id']
+
+
+def test_known_objects_expire(post, monkeypatch):
+    monkeypatch.setattr(known_objects, 'ttl', 0)
+    assert object_exists(Post, post.pk)
+    # Deleted elsewhere, without this process seeing a signal
+    Post.objects.filter(pk=post.pk)._raw_delete(connection.alias)
+    assert not object_exists(Post, post.pk)
+
+
+def test_content_type_field():
+    field = ContentTypeField(commentable)
+    post_type = ContentType.objects.get_for_model(Post)
+    assert field.run_validation(post_type.pk) == post_type
+    assert field.run_validation(str(post_type.pk)) == post_type
+    for data, code in [(ContentType.objects.get_for_model(Comment).pk, 'does_not_exist'), (0, 'does_not_exist'),
+                       ('post', 'incorrect_type'), (True, 'incorrect_type')]:
+        with pytest.raises(serializers.ValidationError) as error:
+            field.run_validation(data)
+        assert error.value.get_codes() == [code]
+
+
+def test_comment_on_unregistered_type(post):
+    history_type = ContentType.objects.get_for_model(CommentsHistory).pk
+    serializer = CommentSerializer(data={**comment_data(post), 'content_type': history_type})
+    assert not serializer.is_valid()
+    assert list(serializer.errors) == ['content_type']
+    _, errors = check_comments([{**comment_data(post), 'content_type': history_type}], commentable)
+    assert list(errors[0]) == ['content_type']
+
+
+def test_registries():
+    types = ContentType.objects.get_for_models(Post, User, Comment, CommentsHistory)
+    assert set(commentable.ids()) == {types[Post].pk, types[User].pk}
+    assert set(subscribable.ids()) == {ct.pk for ct in types.values()}
+    assert set(commentable.queryset()) == {types[Post], types[User]}
+    assert commentable.resolver(types[Comment].pk) is None
+    assert subscribable.resolver(types[Comment].pk).model is Comment
+
+
+def test_registries_cleared_after_migrate():
+    ids = commentable.ids()
+    with CaptureQueriesContext(connection) as queries:
+        commentable.ids()
+    assert len(queries) == 0
+
+    emit_post_migrate_signal(0, False, connection.alias)
+    assert commentable._resolvers is None
+    assert subscribable._resolvers is None
+    assert commentable.ids() == ids
@@ -0,0 +1,236 @@
+import asyncio
+import time
+
+import pytest
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.test import override_settings
+from rest_framework_jwt.settings import api_settings
+
+from comments.consumers import CLOSE_TOO_SLOW, AsyncObjectUpdateConsumer
+from comments.events import COMMENT_CREATED, COMMENT_DELETED, OBJECT_UPDATED, Publisher, make_event
+from comments.models import CommentsHistory, Post, Status
+from core.channels_token_auth import TokenAuthMiddleware, TokenAuthMiddlewareStack
+from core.routing import application
+
+
+@pytest.fixture(autouse=True)
+def channel_layer():
+    with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}):
+        yield get_channel_layer()
+
+
+def make_token(user, **claims):
+    payload = api_settings.JWT_PAYLOAD_HANDLER(user)
+    payload.update(claims)
+    return api_settings.JWT_ENCODE_HANDLER(payload)
+
+
+@pytest.fixture()
+def token():
+    return make_token(User.objects.get(username='admin'))
+
+
+def run(test):
+    async_to_sync(test)()
+
+
+def connect(path, token):
+    return WebsocketCommunicator(application, path, headers=[(b'authorization', token.encode())])
+
+
+@pytest.fixture()
+def export():
+    user = User.objects.get(username='admin')
+    export = CommentsHistory.objects.create(user=user, content_type=ContentType.objects.get_for_model(User),
+                                            object_id=user.pk, format='json', status=Status.error)
+    yield export
+    export.delete()
+
+
+def test_subscribe_normalizes_object_id(channel_layer, token, export):
+    post = Post.objects.order_by('pk').first()
+    post_type = ContentType.objects.get_for_model(Post).pk
+    export_type = ContentType.objects.get_for_model(CommentsHistory).pk
+
+    async def test():
+        client = connect('/object_updates', token)
+        await client.connect()
+        # Named like in the events
+        await client.send_json_to({'action': 'subscribe', 'content_type': post_type, 'object_id': f'0{post.pk}'})
+        await client.send_json_to({'action': 'subscribe', 'content_type': export_type,
+                                   'object_id': str(export.pk).upper()})
+        assert await client.receive_nothing()
+
+        for ct, pk in ((post_type, post.pk), (export_type, str(export.pk))):
+            await channel_layer.group_send(*make_event(ct, pk, {'id': pk}))
+            assert (await client.receive_json_from())['data'] == {'id': pk}
+        await client.disconnect()
+
+    run(test)
+
+
+def test_batch_subscribe(channel_layer, token):
+    post = Post.objects.order_by('pk').first()
+    user = User.objects.get(username='admin')
+    post_type = ContentType.objects.get_for_model(Post).pk
+    user_type = ContentType.objects.get_for_model(User).pk
+    objects = [{'content_type': post_type, 'object_id': post.pk}, {'content_type': user_type, 'object_id': user.pk}]
+
+    async def test():
+        client = connect('/object_updates/batch', token)
+        await client.connect()
+        await client.send_json_to({'action': 'subscribe', 'objects': objects + [
+            {'content_type': post_type, 'object_id': 0}]})
+        error, = (await client.receive_json_from())['error']
+        assert error['object_id'] == '0'
+
+        for ref in objects:
+            await channel_layer.group_send(*make_event(ref['content_type'], ref['object_id'], {'id': 1}))
+            event = await client.receive_json_from()
+            assert (event['content_type'], event['object_id']) == (ref['content_type'], ref['object_id'])
+
+        await client.send_json_to({'action': 'unsubscribe', 'objects': objects})
+        assert await client.receive_nothing()
+        await channel_layer.group_send(*make_event(post_type, post.pk, {'id': 1}))
+        assert await client.receive_nothing()
+        await client.disconnect()
+
+    run(test)
+
+
+def test_coalesced_fanout(channel_layer, token):
+    post = Post.objects.order_by('pk').first()
+    post_type = ContentType.objects.get_for_model(Post).pk
+
+    async def test():
+        publisher = Publisher(0.1)
+        # Fan out from this loop rather than from a thread of its own
+        publisher.loop = asyncio.get_event_loop()
+        client = connect('/object_updates/batch', token)
+        await client.connect()
+        await client.send_json_to({'action': 'subscribe', 'content_type': post_type, 'object_id': post.pk})
+        assert await client.receive_nothing()
+
+        for version in range(5):
+            group, message = make_event(post_type, post.pk, {'version': version})
+            publisher.send((group, message['type'], None), group, message)
+        assert (await client.receive_json_from())['data'] == {'version': 4}
+        assert await client.receive_nothing(0.3)
+        await client.disconnect()
+
+    run(test)
+
+
+class SlowConsumer(AsyncObjectUpdateConsumer):
+    """
+    A client taking ``delay`` seconds per message.
+    """
+    delay = 0.2
+
+    async def send_json(self, content, close=False):
+        await asyncio.sleep(self.delay)
+        await super().send_json(content, close)
+
+
+def connect_slow(user):
+    client = WebsocketCommunicator(SlowConsumer, '/object_updates/batch')
+    client.scope['user'] = user
+    return client
+
+
+def test_comment_events_not_coalesced(channel_layer):
+    post = Post.objects.order_by('pk').first()
+    post_type = ContentType.objects.get_for_model(Post).pk
+    user = User.objects.get(username='admin')
+
+    async def test():
+        client = connect_slow(user)
+        await client.connect()
+        await client.send_json_to({'action': 'subscribe', 'content_type': post_type, 'object_id': post.pk})
+        assert await client.receive_nothing()
+
+        # Queued while the client is busy with the first one
+        for event_type, data in [(COMMENT_CREATED, {'id': 1}), (OBJECT_UPDATED, {'id': 1}),
+                                 (COMMENT_CREATED, {'id': 2}), (OBJECT_UPDATED, {'id': 2}),
+                                 (COMMENT_DELETED, {'id': 1})]:
+            await channel_layer.group_send(*make_event(post_type, post.pk, data, event_type))
+        received = [await client.receive_json_from() for _ in range(4)]
+        assert [(event['type'], event['data']) for event in received] == [
+            (COMMENT_CREATED, {'id': 1}), (OBJECT_UPDATED, {'id': 2}),
+            (COMMENT_CREATED, {'id': 2}), (COMMENT_DELETED, {'id': 1})]
+        assert await client.receive_nothing(0.5)
+        await client.disconnect()
+
+    run(test)
+
+
+@pytest.mark.parametrize('token', ['not a token', 'expired'])
+def test_invalid_token(token):
+    if token == 'expired':
+        token = make_token(User.objects.get(username='admin'), exp=int(time.time()) - 10)
+
+    async def test():
+        connected, _ = await connect('/object_updates/batch', token).connect()
+        assert not connected
+
+    run(test)
+
+
+def test_cached_token(token, monkeypatch):
+    async def test():
+        client = connect('/object_updates/batch', token)
+        assert (await client.connect())[0]
+        await client.disconnect()
+
+        def load_user(payload):
+            raise AssertionError('Not cached')
+
+        monkeypatch.setattr(TokenAuthMiddleware, 'load_user', staticmethod(load_user))
+        client = connect('/object_updates/batch', token)
+        assert (await client.connect())[0]
+        await client.disconnect()
+
+    run(test)
+
+
+def test_token_skips_session(token):
+    scopes = []
+
+    def consumer(scope):
+        scopes.append(scope)
+        return AsyncObjectUpdateConsumer(scope)
+
+    async def test():
+        client = WebsocketCommunicator(TokenAuthMiddlewareStack(consumer, skip_session=True), '/',
+                                       headers=[(b'authorization', token.encode())])
+        assert (await client.connect())[0]
+        await client.disconnect()
+
+    run(test)
+    assert 'session' not in scopes[0]
+    assert scopes[0]['user'].username == 'admin'
+
+
+@override_settings(COMMENTS_WS_SEND_QUEUE_SIZE=2)
+def test_slow_client_closed(channel_layer):
+    post = Post.objects.order_by('pk').first()
+    post_type = ContentType.objects.get_for_model(Post).pk
+    user = User.objects.get(username='admin')
+
+    async def test():
+        client = connect_slow(user)
+        await client.connect()
+        await client.send_json_to({'action': 'subscribe', 'content_type': post_type, 'object_id': post.pk})
+        assert await client.receive_nothing()
+
+        # One being sent, two waiting, no room for the last one
+        for pk in range(4):
+            await channel_layer.group_send(*make_event(post_type, post.pk, {'id': pk}, COMMENT_CREATED))
+        assert await client.receive_output() == {'type': 'websocket.close', 'code': CLOSE_TOO_SLOW}
+        await client.disconnect()
+
+    run(test)